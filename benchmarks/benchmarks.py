@@ -0,0 +1,237 @@
+"""
+Benchmarks for airspeed velocity (asv) on synthetic TMA overviews.
+
+Run with ``make benchmark``, which stores results of the current commit
+in ``benchmarks/results``. ``make benchmark-baseline`` stores results of
+master. ``make benchmark-compare`` runs master and HEAD, and fails if any
+benchmark is more than 20 % slower.
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.ndimage as nd
+from numba import jit
+from skimage.io import imsave
+
+from leicaautomator.filters import mean, pop_bilateral
+from leicaautomator.pipeline import extract_regions, set_well_positions
+from leicaautomator.regions import REGION_DTYPE, RegionTable
+from leicaautomator.utils import apply_chunks, stitch, zick_zack_sort
+
+# field of generated experiments
+IMAGE = os.path.join('slide--S00', 'chamber--U00--V00',
+                     'field--X{x:02d}--Y{y:02d}',
+                     'image--L0000--S00--U00--V00--J08--E00--O00'
+                     '--X{x:02d}--Y{y:02d}--T0000--Z00--C00.png')
+
+
+def synthetic_overview(shape, dtype=np.uint8, cores=(12, 16), seed=0):
+    """TMA overview, textured cores in rows and columns on flat glass.
+
+    Parameters
+    ----------
+    shape : tuple (height, width)
+    dtype : numpy.dtype
+        Unsigned integer type.
+    cores : tuple (rows, columns)
+        Number of cores.
+    seed : int
+        Seed of texture.
+
+    Returns
+    -------
+    2d array
+    """
+    rng = np.random.RandomState(seed)
+    top = np.iinfo(dtype).max
+    spacing = (shape[0] / cores[0], shape[1] / cores[1])
+    radius = 0.35 * min(spacing)
+    yy, xx = np.ogrid[:shape[0], :shape[1]]
+    dy = yy % spacing[0] - spacing[0] / 2
+    dx = xx % spacing[1] - spacing[1] / 2
+    tissue = dy**2 + dx**2 < radius**2
+
+    image = np.full(shape, 0.8 * top)
+    texture = rng.normal(0.4 * top, 0.1 * top, size=shape)
+    image[tissue] = texture[tissue]
+    return np.clip(image, 0, top).astype(dtype)
+
+
+def synthetic_texture(shape, sigma=4, seed=0):
+    """Smooth random uint8 image. Unlike the periodic cores of
+    :func:`synthetic_overview`, tiles of it register unambiguously."""
+    noise = np.random.RandomState(seed).normal(size=shape)
+    image = nd.gaussian_filter(noise, sigma)
+    image = (image - image.min()) / (image.max() - image.min())
+    return (255 * image).astype(np.uint8)
+
+
+def synthetic_regions(count, seed=0):
+    "Regions of cores in a jittered grid with some cores missing."
+    rng = np.random.RandomState(seed)
+    columns = int(np.ceil(np.sqrt(count / 0.9)))
+    row, column = np.divmod(np.arange(columns**2), columns)
+    keep = np.sort(rng.permutation(len(row))[:count])
+    y = row[keep] * 100 + rng.randint(-10, 10, count)
+    x = column[keep] * 100 + rng.randint(-10, 10, count)
+    regions = RegionTable(np.zeros(count, dtype=REGION_DTYPE))
+    regions['label'][:] = np.arange(1, count + 1)
+    regions['y'][:], regions['x'][:] = y, x
+    regions['y_end'][:], regions['x_end'][:] = y + 80, x + 80
+    return regions
+
+
+class Filters(object):
+    params = ([(1024, 1024), (4096, 4096)], ['uint8', 'uint16'])
+    param_names = ['shape', 'dtype']
+
+    def setup(self, shape, dtype):
+        self.image = synthetic_overview(shape, np.dtype(dtype))
+        self.selem = np.ones((9, 9))
+        # compile numba functions outside timing
+        small = np.ascontiguousarray(self.image[:64, :64])
+        pop_bilateral(small, self.selem)
+        mean(small, self.selem)
+
+    def time_pop_bilateral(self, shape, dtype):
+        pop_bilateral(self.image, self.selem)
+
+    def time_mean(self, shape, dtype):
+        mean(self.image, self.selem)
+
+
+@jit(nogil=True, nopython=True)
+def _baseline_pop_bilateral(img, hist, selem_size, out, s0=10, s1=10):
+    "Kernel of the first release, uint8 only, reference for PopBilateral."
+    iy, ix = img.shape
+    pad = selem_size//2
+    for ii in range(selem_size):
+        for jj in range(selem_size):
+            hist[img[ii, jj]] += 1
+    for i in range(1, iy-2*pad):
+        if i%2 == 1:
+            r = range(ix-2*pad)
+        else:
+            r = range(ix-2*pad-1, -1, -1)
+        for j in r:
+            if ((j == 0 and i%2 == 1) or
+                (j == ix-2*pad-1 and i%2 == 0)):
+                for jj in range(selem_size):
+                    hist[img[i-1, j+jj]] -= 1
+                    hist[img[i+selem_size-1, j+jj]] += 1
+            elif i%2 == 1:
+                for ii in range(selem_size):
+                    hist[img[i+ii, j-1]] -= 1
+                    hist[img[i+ii, j+selem_size-1]] += 1
+            else:
+                for ii in range(selem_size):
+                    hist[img[i+ii, j+selem_size]] -= 1
+                    hist[img[i+ii, j]] += 1
+            val = img[i+pad, j+pad]
+            o = 0
+            for h in range(val-s0, val+s1+1):
+                if h < 0 or h > 255:
+                    continue
+                o += hist[h]
+            out[i-1, j] = o
+
+
+def baseline_pop_bilateral(img, selem, s0=10, s1=10):
+    "Population bilateral filter of the first release, uint8 only."
+    pad = selem.shape[0]//2
+    out = np.zeros(img.shape, dtype=np.uint8)
+    img = np.pad(img, ((pad+1, pad), (pad, pad)), mode='edge')
+    _baseline_pop_bilateral(img, np.zeros(256), 2*pad+1, out, s0, s1)
+    return out
+
+
+class PopBilateral(object):
+    """pop_bilateral against the kernel of the first release on uint8,
+    ``time_pop_bilateral`` should not be slower than ``time_baseline``."""
+    params = [(1024, 1024), (2000, 2000)]
+    param_names = ['shape']
+
+    def setup(self, shape):
+        self.image = synthetic_overview(shape)
+        self.selem = np.ones((9, 9))
+        small = np.ascontiguousarray(self.image[:64, :64])
+        pop_bilateral(small, self.selem)
+        baseline_pop_bilateral(small, self.selem)
+
+    def time_pop_bilateral(self, shape):
+        pop_bilateral(self.image, self.selem)
+
+    def time_baseline(self, shape):
+        baseline_pop_bilateral(self.image, self.selem)
+
+
+class ApplyChunks(object):
+    params = ([None, 256, 1024], ['threads', 'processes', 'synchronous'])
+    param_names = ['chunks', 'scheduler']
+
+    def setup(self, chunks, scheduler):
+        self.image = synthetic_overview((2048, 2048))
+        self.selem = np.ones((9, 9))
+        mean(np.ascontiguousarray(self.image[:64, :64]), self.selem)
+
+    def time_mean(self, chunks, scheduler):
+        apply_chunks(mean, self.image, chunks, depth=4,
+                     extra_arguments=(self.selem,), scheduler=scheduler)
+
+
+class Regions(object):
+    params = [100, 1000, 10000]
+    param_names = ['regions']
+
+    def setup(self, count):
+        self.regions = synthetic_regions(count)
+        self.sorted = set_well_positions(self.regions.copy())
+
+    def time_set_well_positions(self, count):
+        set_well_positions(self.regions)
+
+    def time_zick_zack_sort(self, count):
+        zick_zack_sort(self.sorted, ('well_x', 'well_y'))
+
+
+class ExtractRegions(object):
+    params = [(1024, 1024), (4096, 4096)]
+    param_names = ['shape']
+
+    def setup(self, shape):
+        self.binary = synthetic_overview(shape) < 128
+
+    def time_extract_regions(self, shape):
+        extract_regions(self.binary, max_regions=129)
+
+
+class Stitch(object):
+    params = [(4, 4), (8, 8)]
+    param_names = ['fields']
+    timeout = 300
+
+    def setup(self, fields):
+        "Experiment of fields cut from a texture, 25 % overlap."
+        size, step = 256, 192
+        rows, columns = fields
+        overview = synthetic_texture((size + step * (rows - 1),
+                                      size + step * (columns - 1)))
+        self.path = tempfile.mkdtemp()
+        for y in range(rows):
+            for x in range(columns):
+                filename = os.path.join(self.path, IMAGE.format(x=x, y=y))
+                os.makedirs(os.path.dirname(filename))
+                imsave(filename, overview[y*step:y*step + size,
+                                          x*step:x*step + size],
+                       check_contrast=False)
+
+    def teardown(self, fields):
+        shutil.rmtree(self.path)
+
+    def time_stitch(self, fields):
+        stitch(self.path, cache=False)
+
+    def peakmem_stitch(self, fields):
+        stitch(self.path, cache=False)
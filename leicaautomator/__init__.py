@@ -2,9 +2,16 @@ __author__ = 'Arve Seljebu'
 __email__ = 'arve.seljebu@gmail.com'
 __version__ = '0.0.2'
 
-__all__ = ['find_tma_regions']
+__all__ = ['find_tma_regions', 'RegionPipeline', 'RegionTable']
 
 from .automator import *
+from .pipeline import *
+from .regions import *
+from .lattice import *
 from .position import *
 from .filters import *
 from .utils import *
+from .stream import *
+from .scan import *
+from .route import *
+from .tiling import *
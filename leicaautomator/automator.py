@@ -1,37 +1,64 @@
 """
 Finds tissue micro arrays in an overview image and scan those regions.
 """
+import numpy as np
 from skimage import io
-from .viewer import *
+from .pipeline import RegionPipeline
 
 
-def find_tma_regions(image):
+def find_tma_regions(image, interactive=True, preview=False, **parameters):
     """Find tissue micro array regions in an overview scan. Opens a GUI
     which allows for adjusting filter settings and move, remove or add
     regions by mouse clicks.
 
     Parameters
     ----------
-    image : 2d array
-        Overview image to look for tissue samples.
+    image : 2d array or str
+        Overview image to look for tissue samples. A ``.npy`` file, like the
+        one written by ``stitch(experiment, out=...)``, is memory mapped.
+    interactive : bool
+        If False, no GUI is opened and regions are found with
+        :class:`leicaautomator.pipeline.RegionPipeline`.
+    preview : bool
+        Tune filters in GUI on a downsampled image. Commit runs the filters
+        on the full resolution image, regions can be edited after commit.
+        If the GUI is closed before commit, the full resolution image is
+        filtered without the GUI with the settings of the filters.
+    parameters : keywords
+        Passed to :class:`leicaautomator.pipeline.RegionPipeline` when
+        ``interactive=False``.
 
     Returns
     -------
-    skimage.measure.regionprops
-        List of regions with the extra attributes:
+    leicaautomator.regions.RegionTable
+        Regions with the columns:
 
         - ``x``, ``y``, ``x_end``, ``y_end`` : same as ``bbox``.
         - ``well_x`` : column coordinate, 0-indexed.
         - ``well_y`` : row coordinate, 0-indexed.
+        - ``label``, ``area``, ``centroid_y``, ``centroid_x``.
     """
-    if type(image) is str:
+    if type(image) is str and image.endswith('.npy'):
+        image = np.load(image, mmap_mode='r')
+    elif type(image) is str:
         image = io.imread(image)
 
-    viewer = ImageViewer(image)
+    if not interactive:
+        return RegionPipeline(**parameters)(image)
+
+    # Qt and matplotlib only imported when GUI is used
+    from .viewer import (ImageViewer, PopBilateralPlugin, MeanPlugin,
+                         OtsuPlugin, RegionPlugin)
+
+    viewer = ImageViewer(image, preview=preview)
     viewer += PopBilateralPlugin()
     viewer += MeanPlugin()
     viewer += OtsuPlugin()
     viewer += RegionPlugin()
-    return viewer.show()[-1] # output of RegionPlugin
+    viewer.show()
+    if viewer.preview_factor > 1:
+        # closed without commit, window is gone and there are no edits
+        return viewer.region_pipeline()(image)
+    return viewer.plugins[-1].output()
 
 
@@ -24,95 +24,288 @@ def pop_bilateral(img, selem, s0=10, s1=10, which=None):
         are within range [f-s0, f+s1] where f is the value of
         the center pixel. ``dtype`` will depend on input ``selem``.
     """
-    limits = _check_type(img.dtype)
-    hist = np.zeros(limits.max)
-
+    _check_type(img.dtype)
     pad = selem.shape[0]//2 # square selem for now
     selem_size = 2*pad+1
-
     t = _get_out_type(selem_size, 1)
     out = np.zeros(img.shape, dtype=t)
-    img = np.pad(img, ((pad+1, pad), (pad, pad)), mode='edge') # one extra on top
-    _pop_bilateral(img, hist, selem_size, out, s0, s1)
+
+    values, index = _compress(img)
+    # range [f-s0, f+s1] as bin indices [lo, hi)
+    signed = values.astype(np.float64)
+    lo = np.searchsorted(values, signed - s0, side='left').astype(np.int64)
+    hi = np.searchsorted(values, signed + s1, side='right').astype(np.int64)
+    width = np.median(hi - lo)
+    if img.dtype.itemsize == 1:
+        # bins are values, range is summed directly
+        kernel, shift = _pop_bilateral_values, 0
+    elif width <= 64:
+        kernel, shift = _pop_bilateral_bins, 0
+    else:
+        # totals of blocks of bins, wide ranges sum blocks. Block size
+        # about sqrt(width/2) balances bins and blocks summed per range.
+        kernel = _pop_bilateral_blocks
+        shift = max(int(round(np.log2(width / 2) / 2)), 1)
+    hist = np.zeros(len(values), dtype=np.int32)
+    blocks = np.zeros((len(values) >> shift) + 1, dtype=np.int32)
+
+    index = np.pad(index, ((pad+1, pad), (pad, pad)), mode='edge') # one extra on top
+    kernel(index, hist, blocks, shift, lo, hi, s0, s1, selem_size, out)
     return out
 
 
-@jit(nogil=True, nopython=True)
-def _pop_bilateral(img, hist, selem_size, out, s0=10, s1=10):
-    "Sliding window histogram algo"
-    iy, ix = img.shape
-    pad = selem_size//2
-    # initialize histogram
-    for ii in range(selem_size):
-        for jj in range(selem_size):
-            val = img[ii, jj]
-            hist[val] += 1
-    
-    # every pixel in zick zack
-    for i in range(1, iy-2*pad): # rows
-        if i%2 == 1: # zick
-            r = range(ix-2*pad)
-        else: # zack
-            r = range(ix-2*pad-1, -1, -1)
-        
-        for j in r: # cols
-            # update hist
-            if ((j == 0 and i%2 == 1) or
-                (j == ix-2*pad-1 and i%2 == 0)): # row step
-                for jj in range(selem_size):
-                    v1 = img[i-1, j+jj]
-                    v2 = img[i+selem_size-1, j+jj]
-                    hist[v1] -= 1
-                    hist[v2] += 1
-            elif i%2 == 1: # column step forward
-                for ii in range(selem_size):
-                    v1 = img[i+ii, j-1]
-                    v2 = img[i+ii, j+selem_size-1]
-                    hist[v1] -= 1
-                    hist[v2] += 1
-            else: # column step backward
-                for ii in range(selem_size):
-                    v1 = img[i+ii, j+selem_size]
-                    v2 = img[i+ii, j]
-                    hist[v1] -= 1
-                    hist[v2] += 1
-                
-            # get out value
-            val = img[i+pad, j+pad]
-            o = 0
-            for h in range(val-s0, val+s1+1):
-                if h < 0 or h > 255:
-                    continue
-                o += hist[h]
-            out[i-1, j] = o
+def _compress(img):
+    """Map image values to bin indices of the values present, so histograms
+    only need as many bins as there are distinct values.
+
+    Returns
+    -------
+    values, index
+        Sorted distinct values and image of indices into ``values``.
+    """
+    if img.dtype.itemsize == 1:
+        # already small bin indices, keep uint8 for memory bandwidth
+        return np.arange(256, dtype=img.dtype), img
+    if img.dtype.itemsize <= 2:
+        # O(n) for uint16
+        present = np.bincount(img.ravel(), minlength=1) > 0
+        values = np.flatnonzero(present).astype(img.dtype)
+        lookup = (np.cumsum(present) - 1).astype(np.int32)
+        return values, lookup[img]
+    values, index = np.unique(img, return_inverse=True)
+    return values, index.reshape(img.shape).astype(np.int32)
+
+
+@jit(nogil=True, nopython=True, inline='always')
+def _add(hist, blocks, shift, v, value):
+    "Add value to bin v."
+    hist[v] += value
+
+
+@jit(nogil=True, nopython=True, inline='always')
+def _add_blocked(hist, blocks, shift, v, value):
+    "Add value to bin v and its block."
+    hist[v] += value
+    blocks[v >> shift] += value
+
+
+@jit(nogil=True, nopython=True, inline='always')
+def _sum(hist, start, stop):
+    "Sum of bins [start, stop)."
+    s = 0
+    for h in range(start, stop):
+        s += hist[h]
+    return s
+
+
+@jit(nogil=True, nopython=True, inline='always')
+def _count_values(hist, blocks, shift, lo, hi, s0, s1, v):
+    "Population of values [v-s0, v+s1], bins are values."
+    n = hist.shape[0]
+    s = 0
+    for h in range(v - s0, v + s1 + 1):
+        if h < 0 or h >= n:
+            continue
+        s += hist[h]
+    return s
+
+
+@jit(nogil=True, nopython=True, inline='always')
+def _count_bins(hist, blocks, shift, lo, hi, s0, s1, v):
+    "Population of bins [lo[v], hi[v])."
+    return _sum(hist, lo[v], hi[v])
+
+
+@jit(nogil=True, nopython=True, inline='always')
+def _count_blocked(hist, blocks, shift, lo, hi, s0, s1, v):
+    "Population of bins [lo[v], hi[v]), whole blocks from block totals."
+    start, stop = lo[v], hi[v]
+    first = (start + (1 << shift) - 1) >> shift
+    last = stop >> shift
+    if first >= last: # narrow range
+        return _sum(hist, start, stop)
+    s = _sum(hist, start, first << shift) + _sum(hist, last << shift, stop)
+    for b in range(first, last):
+        s += blocks[b]
+    return s
+
+
+def _window_kernel(update, count):
+    """Sliding window histogram algo. ``update`` adds to the histogram in
+    O(1), ``count`` is the population of the range of the center pixel.
+    """
+    @jit(nogil=True, nopython=True)
+    def kernel(index, hist, blocks, shift, lo, hi, s0, s1, selem_size, out):
+        iy, ix = index.shape
+        pad = selem_size//2
+        # initialize histogram
+        for ii in range(selem_size):
+            for jj in range(selem_size):
+                update(hist, blocks, shift, index[ii, jj], 1)
+
+        # every pixel in zick zack
+        for i in range(1, iy-2*pad): # rows
+            if i%2 == 1: # zick
+                r = range(ix-2*pad)
+            else: # zack
+                r = range(ix-2*pad-1, -1, -1)
+
+            for j in r: # cols
+                # update hist
+                if ((j == 0 and i%2 == 1) or
+                    (j == ix-2*pad-1 and i%2 == 0)): # row step
+                    for jj in range(selem_size):
+                        update(hist, blocks, shift, index[i-1, j+jj], -1)
+                        update(hist, blocks, shift,
+                               index[i+selem_size-1, j+jj], 1)
+                elif i%2 == 1: # column step forward
+                    for ii in range(selem_size):
+                        update(hist, blocks, shift, index[i+ii, j-1], -1)
+                        update(hist, blocks, shift,
+                               index[i+ii, j+selem_size-1], 1)
+                else: # column step backward
+                    for ii in range(selem_size):
+                        update(hist, blocks, shift,
+                               index[i+ii, j+selem_size], -1)
+                        update(hist, blocks, shift, index[i+ii, j], 1)
+
+                # get out value
+                out[i-1, j] = count(hist, blocks, shift, lo, hi, s0, s1,
+                                    index[i+pad, j+pad])
+    return kernel
+
+
+_pop_bilateral_values = _window_kernel(_add, _count_values)
+_pop_bilateral_bins = _window_kernel(_add, _count_bins)
+_pop_bilateral_blocks = _window_kernel(_add_blocked, _count_blocked)
 
 
 def mean(img, selem):
-    img = img.astype(np.uint32)
-    out = np.empty(img.shape, dtype=np.uint8)
+    """Mean filter with square structuring element. Running sums in both
+    directions, cost per pixel does not depend on selem size.
+
+    Parameters
+    ----------
+    img : 2d array uint
+        Image.
+    selem : 2d array
+        Structuring element. Only y-shape will be considered,
+        resulting in a square selem.
+
+    Returns
+    -------
+    2d array
+        Mean of neighborhood rounded to nearest integer, same ``dtype`` as
+        ``img``. Edge pixels are repeated outside the image.
+    """
+    _check_type(img.dtype)
+    out = np.empty(img.shape, dtype=img.dtype)
     pad = selem.shape[0]//2 # square selem for now
-    img = np.pad(img, pad, mode='edge')
-    rows = np.zeros(img.shape, dtype=np.uint32) # size of padded
     selem_size = 2*pad+1
-    _mean(img, selem_size, rows, out)
+    colsum = np.zeros(img.shape[1], dtype=np.int64)
+    _mean(img, selem_size, colsum, out)
     return out
 
 
 @jit(nopython=True, nogil=True)
-def _mean(img, selem_size, rows, out):
+def _mean(img, selem_size, colsum, out):
+    "Running column sums and running sum along rows."
     iy, ix = img.shape
     pad = selem_size//2
-    for i in range(iy-2*pad):
-        for j in range(ix):
-            for ii in range(selem_size):
-                rows[i, j] += img[i+ii, j]
-    # 2n instead of n^2
-    for i in range(iy-2*pad):
-        for j in range(ix-2*pad):
-            o = 0
-            for jj in range(selem_size):
-                o += rows[i, j+jj]
-            out[i, j] = o // selem_size**2
+    area = selem_size**2
+    half = area//2
+    # column sums of first window, clamp indices for edge mode
+    for j in range(ix):
+        for ii in range(-pad, pad+1):
+            colsum[j] += img[min(max(ii, 0), iy-1), j]
+
+    for i in range(iy):
+        if i > 0: # slide window one row down
+            add = min(i+pad, iy-1)
+            sub = max(i-pad-1, 0)
+            for j in range(ix):
+                colsum[j] += img[add, j]
+                colsum[j] -= img[sub, j]
+
+        o = 0
+        for jj in range(-pad, pad+1):
+            o += colsum[min(max(jj, 0), ix-1)]
+        out[i, 0] = (o + half) // area
+        for j in range(1, ix):
+            o += colsum[min(j+pad, ix-1)] - colsum[max(j-pad-1, 0)]
+            out[i, j] = (o + half) // area
+
+
+def otsu_from_histogram(hist):
+    """Otsu threshold of an integer valued image, computed from its
+    histogram in O(bins).
+
+    Parameters
+    ----------
+    hist : 1d array
+        Histogram where ``hist[v]`` is number of pixels with value ``v``.
+
+    Returns
+    -------
+    int
+        Threshold, same as :func:`skimage.filters.threshold_otsu`.
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    values = np.arange(len(hist))
+    # class 1 is values <= t, class 2 is values > t
+    weight1 = np.cumsum(hist)
+    weight2 = weight1[-1] - weight1
+    sum1 = np.cumsum(hist * values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean1 = sum1 / weight1
+        mean2 = (sum1[-1] - sum1) / weight2
+    variance = np.nan_to_num(weight1 * weight2 * (mean1 - mean2)**2)
+    return int(np.argmax(variance[:-1])) if len(hist) > 1 else 0
+
+
+def li_from_histogram(hist):
+    """Li's minimum cross entropy threshold of an integer valued image,
+    computed from its histogram. Each iteration is O(bins).
+
+    Parameters
+    ----------
+    hist : 1d array
+        Histogram where ``hist[v]`` is number of pixels with value ``v``.
+
+    Returns
+    -------
+    float
+        Threshold, same as :func:`skimage.filters.threshold_li`.
+    """
+    hist = np.asarray(hist, dtype=np.float64)
+    present = np.flatnonzero(hist)
+    if len(present) < 2:
+        return float(present[0]) if len(present) else 0.
+    # algorithm needs positive values, because of log(mean)
+    offset = present[0]
+    hist = hist[offset:present[-1]+1]
+    values = np.arange(len(hist), dtype=np.float64)
+    cumcount = np.cumsum(hist)
+    cumsum = np.cumsum(hist * values)
+    tolerance = np.diff(present).min() / 2
+
+    def class_means(t):
+        "mean of background (<= t) and foreground (> t)"
+        i = min(int(np.floor(t)), len(hist) - 1)
+        back = cumsum[i] / cumcount[i] if cumcount[i] else 0.
+        fore = (cumsum[-1] - cumsum[i]) / (cumcount[-1] - cumcount[i])
+        return back, fore
+
+    t_next = cumsum[-1] / cumcount[-1]
+    t_current = -2 * tolerance
+    while abs(t_next - t_current) > tolerance:
+        t_current = t_next
+        mean_back, mean_fore = class_means(t_current)
+        if mean_back == 0:
+            break
+        t_next = ((mean_back - mean_fore) /
+                  (np.log(mean_back) - np.log(mean_fore)))
+    return t_next + offset
 
 
 def _check_type(dtype):
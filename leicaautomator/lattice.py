@@ -0,0 +1,245 @@
+"""
+Fit a rectangular lattice to region centroids, to find rows and columns of
+slightly rotated slides with missing cores.
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .regions import RegionTable
+
+__all__ = ['Lattice', 'fit_lattice']
+
+
+class Lattice(object):
+    """Rectangular lattice of wells.
+
+    Parameters
+    ----------
+    origin : tuple (y, x)
+        Position of well (0, 0) in pixels.
+    spacing : tuple (dy, dx)
+        Distance between rows and columns in pixels, 0 if there is only
+        one row or column.
+    rotation : float
+        Counter clockwise rotation of columns relative to the image x-axis,
+        in radians.
+    residual : float, optional
+        Root mean square distance between fitted points and the lattice.
+    """
+    def __init__(self, origin, spacing, rotation, residual=None):
+        self.origin = tuple(float(o) for o in origin)
+        self.spacing = tuple(float(s) for s in spacing)
+        self.rotation = float(rotation)
+        self.residual = residual
+
+    @property
+    def _axes(self):
+        "Unit vectors (y, x) of lattice rows and columns in image."
+        sin, cos = np.sin(self.rotation), np.cos(self.rotation)
+        return np.array([cos, -sin]), np.array([sin, cos])
+
+    def _rotated(self, y, x):
+        "Coordinates relative to origin along lattice axes."
+        row_axis, column_axis = self._axes
+        points = np.column_stack([np.ravel(y), np.ravel(x)]) - self.origin
+        return np.dot(points, row_axis), np.dot(points, column_axis)
+
+    def indices(self, y, x):
+        """Nearest well of positions.
+
+        Parameters
+        ----------
+        y, x : array
+            Positions in pixels.
+
+        Returns
+        -------
+        tuple (well_y, well_x)
+            Arrays of int, relative to well (0, 0) at ``origin``.
+        """
+        result = []
+        for c, s in zip(self._rotated(y, x), self.spacing):
+            result.append(np.rint(c / s).astype(np.int32) if s
+                          else np.zeros(len(c), dtype=np.int32))
+        return tuple(result)
+
+    def position(self, well_y, well_x):
+        """Position of wells in pixels.
+
+        Parameters
+        ----------
+        well_y, well_x : int or array
+            Row and column.
+
+        Returns
+        -------
+        tuple (y, x)
+        """
+        row_axis, column_axis = self._axes
+        well_y = np.asarray(well_y, dtype=np.float64)[..., None]
+        well_x = np.asarray(well_x, dtype=np.float64)[..., None]
+        p = (np.array(self.origin) + well_y * self.spacing[0] * row_axis +
+             well_x * self.spacing[1] * column_axis)
+        return p[..., 0], p[..., 1]
+
+    def assign(self, regions):
+        """Set well_x/y of regions to nearest well of their centroid.
+
+        Parameters
+        ----------
+        regions : RegionTable
+
+        Returns
+        -------
+        RegionTable
+            New table of regions sorted by ``y``, then ``x``, as
+            :func:`leicaautomator.pipeline.set_well_positions`. ``regions``
+            is not changed.
+        """
+        regions = RegionTable.from_regions(regions)
+        # sorting copies, input is left untouched
+        regions = regions[np.lexsort((regions['x'], regions['y']))]
+        well_y, well_x = self.indices(regions['centroid_y'],
+                                      regions['centroid_x'])
+        regions['well_y'][:] = well_y
+        regions['well_x'][:] = well_x
+        return regions
+
+    def __repr__(self):
+        return ('Lattice(origin=(%.1f, %.1f), spacing=(%.1f, %.1f), '
+                'rotation=%.4f, residual=%s)' % (self.origin + self.spacing +
+                (self.rotation, self.residual)))
+
+
+def _neighbours(points, k=8):
+    "Vectors (y, x) from each point to its k nearest neighbours."
+    k = min(k, len(points) - 1)
+    if k < 1:
+        return np.zeros((0, 2)), np.zeros(0, dtype=bool)
+    distance, index = cKDTree(points).query(points, k=k+1)
+    vectors = (points[index[:, 1:]] - points[:, None]).reshape(-1, 2)
+    # diagonals are at least sqrt(2) times longer than nearest neighbour
+    direct = (distance[:, 1:] < 1.3 * distance[:, 1:2]).ravel()
+    return vectors, direct
+
+
+def _rotation(vectors):
+    "Rotation of lattice from neighbour vectors, modulo 90 degrees."
+    if not len(vectors):
+        return 0.
+    angle = 4 * np.arctan2(vectors[:, 0], vectors[:, 1])
+    # mode of angles, diagonals of missing neighbours are outliers
+    bins = np.round(np.degrees(angle)).astype(int) % 360
+    histogram = np.bincount(bins, minlength=360)
+    wrapped = np.concatenate([histogram[-10:], histogram, histogram[:10]])
+    density = np.convolve(wrapped, np.ones(21), mode='valid')
+    mode = np.radians(np.argmax(density))
+    near = np.cos(angle - mode) > np.cos(np.radians(20))
+    return np.angle(np.exp(1j*angle[near]).sum()) / 4
+
+
+def _spacing(along, across):
+    "Spacing from neighbour vectors projected on an axis, 0 if undefined."
+    aligned = np.abs(along[np.abs(along) > 2*np.abs(across)])
+    if not len(aligned):
+        return 0.
+    # neighbours across missing wells are multiples of spacing, spacing is
+    # the largest candidate which all lengths are close to a multiple of
+    candidates = np.concatenate([np.percentile(aligned, range(5, 55, 5)) / m
+                                 for m in (1, 2, 3)])
+    score = np.cos(2*np.pi * aligned / candidates[:, None]).mean(axis=1)
+    spacing = candidates[score >= 0.9 * score.max()].max()
+    return np.median(aligned / np.maximum(np.rint(aligned / spacing), 1))
+
+
+def _phase(coordinates, spacing):
+    "Offset of lattice along an axis, by circular mean of phase."
+    if not spacing:
+        return np.median(coordinates)
+    phase = np.exp(2j*np.pi * coordinates / spacing)
+    return np.angle(phase.sum()) / (2*np.pi) * spacing
+
+
+def fit_lattice(y, x=None, iterations=2):
+    """Fit rectangular lattice to points. Rotation is estimated from the
+    direction of vectors to nearest neighbours, spacing from their length
+    and origin from the phase of points along each axis. The fit is then
+    refined by least squares on the assigned wells. Missing wells, like
+    whole rows, do not affect the fit.
+
+    Parameters
+    ----------
+    y, x : array
+        Positions, like region centroids. If ``x`` is not given, ``y`` is a
+        RegionTable and its centroids are used.
+    iterations : int
+        Number of least squares refinements.
+
+    Returns
+    -------
+    Lattice
+        Fitted lattice, with well (0, 0) at the top left well with points.
+
+    Example
+    -------
+    >>> lattice = fit_lattice(regions)
+    >>> regions = lattice.assign(regions)
+    >>> lattice.spacing, lattice.residual
+    """
+    if x is None:
+        regions = RegionTable.from_regions(y)
+        y, x = regions['centroid_y'], regions['centroid_x']
+    points = np.column_stack([y, x]).astype(np.float64)
+    if not len(points):
+        raise ValueError('Cannot fit lattice to zero points')
+
+    vectors, direct = _neighbours(points)
+    lattice = Lattice((0, 0), (0, 0), _rotation(vectors[direct]))
+    row_axis, column_axis = lattice._axes
+    spacing = (_spacing(np.dot(vectors, row_axis), np.dot(vectors, column_axis)),
+               _spacing(np.dot(vectors, column_axis), np.dot(vectors, row_axis)))
+    rotated = lattice._rotated(y, x)
+    offset = [_phase(c, s) for c, s in zip(rotated, spacing)]
+    origin = offset[0] * row_axis + offset[1] * column_axis
+    lattice = Lattice(origin, spacing, lattice.rotation)
+
+    for _ in range(iterations):
+        well_y, well_x = lattice.indices(y, x)
+        lattice = _refine(points, well_y, well_x, lattice)
+
+    # top left well with points is (0, 0)
+    well_y, well_x = lattice.indices(y, x)
+    origin = lattice.position(well_y.min(), well_x.min())
+    lattice = Lattice(origin, lattice.spacing, lattice.rotation)
+    well_y, well_x = lattice.indices(y, x)
+    fitted = np.column_stack(lattice.position(well_y, well_x))
+    lattice.residual = float(np.sqrt(((points - fitted)**2).sum(axis=1)
+                                     .mean()))
+    return lattice
+
+
+def _refine(points, well_y, well_x, lattice):
+    "Least squares fit of origin and lattice vectors to assigned wells."
+    columns = [np.ones(len(points))]
+    defined = [len(np.unique(w)) > 1 for w in (well_y, well_x)]
+    for w, d in zip((well_y, well_x), defined):
+        if d:
+            columns.append(w)
+    solution = np.linalg.lstsq(np.column_stack(columns), points, rcond=None)[0]
+    origin, vectors = solution[0], list(solution[1:])
+
+    # orthogonal lattice: average rotation of row and column vectors
+    angles, spacing = [], []
+    for axis, d in enumerate(defined):
+        if not d:
+            spacing.append(0.)
+            continue
+        v = vectors.pop(0)
+        spacing.append(np.hypot(*v))
+        if axis == 0: # row vector points down, (cos, -sin)
+            angles.append(np.arctan2(-v[1], v[0]))
+        else: # column vector points right, (sin, cos)
+            angles.append(np.arctan2(v[0], v[1]))
+    rotation = np.angle(np.exp(1j*np.array(angles)).sum()) if angles \
+               else lattice.rotation
+    return Lattice(origin, spacing, rotation)
@@ -0,0 +1,553 @@
+"""
+Headless region finding. Runs the same filter stages as the viewer plugins,
+but with explicit parameters and without Qt or matplotlib.
+"""
+import numpy as np
+import scipy.ndimage as nd
+from skimage import filters
+
+from .filters import (pop_bilateral, mean, otsu_from_histogram,
+                      li_from_histogram, _get_out_type)
+from .lattice import fit_lattice
+from .regions import RegionTable
+from .utils import apply_chunks, map_tiles, chunk_histogram
+
+__all__ = ['RegionPipeline', 'bilateral_filter', 'mean_filter',
+           'otsu_threshold', 'li_threshold', 'fused_filter',
+           'extract_regions',
+           'set_well_positions', 'assign_wells', 'WellGrid',
+           'preview_factor', 'scale_selem']
+
+
+def _selem(size):
+    "Square structuring element."
+    return np.ones((size, size), dtype=np.uint8)
+
+
+def preview_factor(shape, max_size=2048):
+    """Downsampling factor of pyramid level which fits within ``max_size``.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of full resolution image.
+    max_size : int
+        Maximum side length of preview image, typically screen size.
+
+    Returns
+    -------
+    int
+        Power of two, 1 if image already fits.
+
+    Example
+    -------
+    >>> preview_factor((20000, 10000), 2048)
+    16
+    """
+    factor = 1
+    while max(shape[:2]) > factor * max_size:
+        factor *= 2
+    return factor
+
+
+def scale_selem(size, factor):
+    "Selem size scaled down by ``factor``, odd and at least 3."
+    return max(3, (size // factor) | 1)
+
+
+def bilateral_filter(img, selem_size=9, s0=10, s1=10, scheduler='threads'):
+    """Population bilateral filter, inverted and stretched to uint8. Textured
+    areas (tissue) become bright, flat areas (glass) dark.
+
+    Parameters
+    ----------
+    img : 2d array uint
+        Overview image.
+    selem_size : int
+        Side length of square structuring element.
+    s0, s1 : int
+        Lower and higher bound of intensity range, see
+        :func:`leicaautomator.filters.pop_bilateral`.
+    scheduler : 'threads', 'processes' or 'synchronous'
+        See :func:`leicaautomator.utils.apply_chunks`.
+
+    Returns
+    -------
+    2d array uint8
+    """
+    filtered = apply_chunks(pop_bilateral, img, depth=selem_size//2,
+                            extra_arguments=(_selem(selem_size),),
+                            extra_keywords={'s0': s0, 's1': s1},
+                            scheduler=scheduler)
+    return _invert_normalize(filtered, selem_size**2)
+
+
+def _invert_normalize(filtered, population):
+    "Invert population count and stretch to full uint8 range."
+    inverted = population - filtered.astype(np.float64)
+    inverted -= inverted.min()
+    maximum = inverted.max()
+    if maximum:
+        inverted *= 255 / maximum
+    return inverted.astype(np.uint8)
+
+
+def mean_filter(img, selem_size=9, scheduler='threads'):
+    """Mean filter with square structuring element.
+
+    Parameters
+    ----------
+    img : 2d array uint
+    selem_size : int
+        Side length of square structuring element.
+    scheduler : 'threads', 'processes' or 'synchronous'
+        See :func:`leicaautomator.utils.apply_chunks`.
+
+    Returns
+    -------
+    2d array
+        Same ``dtype`` as ``img``.
+    """
+    return apply_chunks(mean, img, depth=selem_size//2,
+                        extra_arguments=(_selem(selem_size),),
+                        scheduler=scheduler)
+
+
+def _streamable(img):
+    "Whether histogram of img can be accumulated chunk by chunk."
+    return img.dtype.kind == 'u' and img.dtype.itemsize <= 2
+
+
+def otsu_threshold(img):
+    """Binary image of pixels at or above Otsu threshold. For uint8/uint16 the
+    threshold is found from a histogram accumulated chunk by chunk, so
+    ``img`` may be memory mapped or a dask array.
+    """
+    if _streamable(img):
+        t = otsu_from_histogram(chunk_histogram(img))
+    else:
+        t = filters.threshold_otsu(img)
+    return img >= t
+
+
+def li_threshold(img, invert=False):
+    """Binary image of pixels at or above Li threshold, below if ``invert``.
+    Streaming histogram for uint8/uint16, see :func:`otsu_threshold`.
+    """
+    if _streamable(img):
+        t = li_from_histogram(chunk_histogram(img))
+    else:
+        t = filters.threshold_li(img)
+    if invert:
+        return img < t
+    return img >= t
+
+
+def _fused_tile(tile, bilateral_selem, s0, s1, mean_selem):
+    "Population bilateral, inversion and mean of one tile."
+    count = pop_bilateral(tile, _selem(bilateral_selem), s0, s1)
+    inverted = np.subtract(bilateral_selem**2, count, dtype=count.dtype)
+    return mean(inverted, _selem(mean_selem))
+
+
+def _bincount(tile):
+    return np.bincount(tile.ravel())
+
+
+def fused_filter(img, bilateral_selem=9, s0=10, s1=10, mean_selem=9,
+                 scheduler='threads', out=None):
+    """Same as :func:`bilateral_filter`, :func:`mean_filter` and
+    :func:`otsu_threshold` in series, but every tile runs through all stages
+    at once with the combined overlap. Only the smoothed image is kept in
+    memory, instead of one image per stage.
+
+    Stretching to uint8 is skipped, as Otsu threshold does not change by
+    stretching. The Otsu threshold is found from the sum of histograms of
+    each tile. The result may differ from the separate stages by a
+    rounding of the stretched intensities.
+
+    Parameters
+    ----------
+    img : 2d array uint
+        Overview image, may be memory mapped. Only one tile per worker is
+        read into memory at a time.
+    bilateral_selem, s0, s1 : int
+        Parameters of :func:`bilateral_filter`.
+    mean_selem : int
+        Parameters of :func:`mean_filter`.
+    scheduler : 'threads' or 'synchronous'
+        See :func:`leicaautomator.utils.map_tiles`.
+    out : str, optional
+        Filename of ``.npy`` file to keep the smoothed image in, instead of
+        memory.
+
+    Returns
+    -------
+    2d array bool
+    """
+    depth = bilateral_selem//2 + mean_selem//2
+    dtype = _get_out_type(bilateral_selem, 1)
+    if out is None:
+        smoothed = np.empty(img.shape, dtype=dtype)
+    else:
+        smoothed = np.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                                             shape=img.shape)
+    hists = map_tiles(_fused_tile, img, smoothed, depth=depth,
+                      partial=_bincount, scheduler=scheduler,
+                      extra_arguments=(bilateral_selem, s0, s1, mean_selem))
+    hist = np.zeros(bilateral_selem**2 + 1, dtype=np.int64)
+    for h in hists:
+        hist[:len(h)] += h
+    return smoothed >= otsu_from_histogram(hist)
+
+
+def extract_regions(binary, max_regions=129):
+    """Label binary image and extract the largest regions. The label image
+    is freed when regions are measured.
+
+    Parameters
+    ----------
+    binary : 2d array bool
+        Segmented image.
+    max_regions : int
+        Number of regions to keep, largest first.
+
+    Returns
+    -------
+    leicaautomator.regions.RegionTable
+        Regions, largest first, with ``label``, ``x``, ``y``, ``x_end``,
+        ``y_end`` (bbox), ``centroid`` and ``area``.
+    """
+    # 8-connectivity, background is 0 and labels start at 1
+    labels, _ = nd.label(binary, structure=np.ones((3, 3)))
+    return RegionTable.from_labels(labels, max_regions)
+
+
+def _sorted_wells(coordinates):
+    "Well index of sorted coordinates, new well at gaps > half largest gap."
+    wells = np.zeros(len(coordinates), dtype=np.int32)
+    if len(coordinates) > 1:
+        dx = np.diff(coordinates)
+        # if gradient to prev coordinate is high, we have a new row/column
+        np.cumsum(dx > dx.max() * 0.5, out=wells[1:])
+    return wells
+
+
+def assign_wells(coordinates):
+    """Row or column index of coordinates. A new row/column starts where
+    the gap between consecutive sorted coordinates is larger than half of
+    the largest gap.
+
+    Parameters
+    ----------
+    coordinates : 1d array
+        Position of regions along one axis.
+
+    Returns
+    -------
+    1d array int
+        Well index of each coordinate, 0-indexed.
+    """
+    coordinates = np.asarray(coordinates)
+    order = np.argsort(coordinates, kind='mergesort')
+    wells = np.empty(len(order), dtype=np.int32)
+    wells[order] = _sorted_wells(coordinates[order])
+    return wells
+
+
+def set_well_positions(regions):
+    """Set well_x/y of regions, see :func:`assign_wells`.
+
+    Parameters
+    ----------
+    regions : RegionTable or list of skimage.regionprops
+        Regions with ``x`` and ``y``.
+
+    Returns
+    -------
+    RegionTable
+        New table of regions with ``well_x`` and ``well_y`` set (0-indexed),
+        sorted by ``y``, then ``x``. ``regions`` is not changed, so it may be
+        read only, like from :func:`leicaautomator.utils.load_regions`.
+    """
+    regions = RegionTable.from_regions(regions)
+    # sorting copies, input is left untouched
+    regions = regions[np.lexsort((regions['x'], regions['y']))]
+    regions['well_x'][:] = assign_wells(regions['x'])
+    regions['well_y'][:] = assign_wells(regions['y'])
+    return regions
+
+
+class WellGrid(object):
+    """Keep well_x/y of regions up to date while single regions are moved,
+    added or removed. Coordinates are kept sorted, so an edit is a sorted
+    insert and a cumulative sum instead of sorting all regions again.
+
+    Parameters
+    ----------
+    regions : RegionTable
+        Regions, well_x/y are set in place. Rows are not reordered. A read
+        only table, like from :func:`leicaautomator.utils.load_regions`, is
+        copied, use ``grid.regions`` to get it.
+
+    Example
+    -------
+    >>> grid = WellGrid(regions)
+    >>> grid.move(label, dy=10, dx=-5)
+    >>> region = grid.add(y, x, y_end, x_end)
+    >>> grid.remove(region.label)
+    """
+    def __init__(self, regions):
+        if not regions.records.flags.writeable:
+            regions = regions.copy()
+        self.regions = regions
+        self.update()
+
+    def update(self):
+        "Sort all regions and set well positions."
+        self._rows = {}
+        self._coordinates = {}
+        for direction in 'xy':
+            coordinates = self.regions[direction]
+            rows = np.argsort(coordinates, kind='mergesort')
+            self._rows[direction] = rows
+            self._coordinates[direction] = coordinates[rows]
+            self._assign(direction)
+
+    def _assign(self, direction):
+        wells = _sorted_wells(self._coordinates[direction])
+        self.regions['well_' + direction][self._rows[direction]] = wells
+
+    def _take(self, direction, row):
+        "Remove row from sorted coordinates."
+        i = np.flatnonzero(self._rows[direction] == row)[0]
+        self._rows[direction] = np.delete(self._rows[direction], i)
+        self._coordinates[direction] = np.delete(self._coordinates[direction],
+                                                 i)
+
+    def _insert(self, direction, row):
+        "Insert row in sorted coordinates."
+        value = self.regions[direction][row]
+        i = np.searchsorted(self._coordinates[direction], value, side='right')
+        self._rows[direction] = np.insert(self._rows[direction], i, row)
+        self._coordinates[direction] = np.insert(self._coordinates[direction],
+                                                 i, value)
+
+    def _reposition(self, direction, row):
+        "Move row to its new place in sorted coordinates, shifting in place."
+        rows = self._rows[direction]
+        coordinates = self._coordinates[direction]
+        value = self.regions[direction][row]
+        i = np.flatnonzero(rows == row)[0]
+        j = np.searchsorted(coordinates, value, side='right')
+        if j > i: # old value is counted by searchsorted
+            j -= 1
+            rows[i:j] = rows[i+1:j+1]
+            coordinates[i:j] = coordinates[i+1:j+1]
+        else:
+            rows[j+1:i+1] = rows[j:i]
+            coordinates[j+1:i+1] = coordinates[j:i]
+        rows[j] = row
+        coordinates[j] = value
+
+    def move(self, label, dy, dx):
+        """Move region.
+
+        Parameters
+        ----------
+        label : int
+            Region to move.
+        dy, dx : int
+            Displacement in pixels.
+        """
+        row = self.regions.index(label)
+        for direction, d in (('y', dy), ('x', dx)):
+            self.regions[direction][row] += d
+            self.regions[direction + '_end'][row] += d
+            self.regions['centroid_' + direction][row] += d
+            self._reposition(direction, row)
+            self._assign(direction)
+
+    def add(self, y, x, y_end, x_end, **kwargs):
+        """Add region, see :meth:`RegionTable.append`. Returns view of the
+        new region.
+        """
+        region = self.regions.append(y, x, y_end, x_end, **kwargs)
+        for direction in 'xy':
+            self._insert(direction, region.index)
+            self._assign(direction)
+        return region
+
+    def remove(self, label):
+        "Remove region."
+        row = self.regions.index(label)
+        self.regions.remove(label)
+        for direction in 'xy':
+            self._take(direction, row)
+            rows = self._rows[direction]
+            rows[rows > row] -= 1
+            self._assign(direction)
+
+
+class RegionPipeline(object):
+    """Find tissue micro array regions without a GUI. Stages are the same as
+    the viewer plugins ``PopBilateralPlugin`` -> ``MeanPlugin`` ->
+    ``OtsuPlugin`` -> ``RegionPlugin``.
+
+    Parameters
+    ----------
+    bilateral_selem : int or None
+        Selem size of population bilateral filter. None disables the stage.
+    s0, s1 : int
+        Intensity range of population bilateral filter.
+    mean_selem : int or None
+        Selem size of mean filter. None disables the stage.
+    threshold : bool
+        Whether to apply Otsu threshold. Disable if input already is binary.
+    max_regions : int
+        Maximum number of regions to keep, largest first.
+    scheduler : 'threads', 'processes' or 'synchronous'
+        How filters are parallelized, see
+        :func:`leicaautomator.utils.apply_chunks`.
+    fused : bool
+        Run bilateral, mean and threshold with :func:`fused_filter` when
+        all of them are enabled. Uses less memory on large images. Tiles
+        are written in place, so ``'processes'`` runs fused stages in
+        threads.
+    cache : leicaautomator.utils.StageCache, optional
+        Cache of stage results. When running the pipeline several times on
+        the same image, only stages with changed parameters and the stages
+        after them are recomputed.
+    grid : 'gaps' or 'lattice'
+        How well positions are found. ``'gaps'`` splits rows and columns at
+        large gaps, see :func:`set_well_positions`. ``'lattice'`` fits a
+        lattice to region centroids, see
+        :func:`leicaautomator.lattice.fit_lattice`, which handles rotated
+        slides and missing rows. The fitted lattice is stored as
+        ``pipeline.lattice``.
+
+    Example
+    -------
+    >>> pipeline = RegionPipeline(mean_selem=15)
+    >>> regions = pipeline(image)
+    >>> [(r.well_x, r.well_y) for r in regions]
+    """
+    def __init__(self, bilateral_selem=9, s0=10, s1=10, mean_selem=9,
+                 threshold=True, max_regions=129, scheduler='threads',
+                 fused=False, cache=None, grid='gaps'):
+        self.bilateral_selem = bilateral_selem
+        self.s0 = s0
+        self.s1 = s1
+        self.mean_selem = mean_selem
+        self.threshold = threshold
+        self.max_regions = max_regions
+        self.scheduler = scheduler
+        self.fused = fused
+        self.cache = cache
+        self.grid = grid
+        self.lattice = None
+        self._preview = None # (image, factor, strided view)
+
+    def _stage(self, function, image, **parameters):
+        "Run stage, through cache if given."
+        if self.cache is None:
+            return function(image, **parameters)
+        return self.cache.cached(function, image, **parameters)
+
+    def filter(self, image):
+        "Run filter stages, returns binary image."
+        if (self.fused and self.bilateral_selem and self.mean_selem and
+                self.threshold):
+            # processes can not write tiles into shared output
+            scheduler = self.scheduler
+            if scheduler == 'processes':
+                scheduler = 'threads'
+            return self._stage(fused_filter, image,
+                               bilateral_selem=self.bilateral_selem,
+                               s0=self.s0, s1=self.s1,
+                               mean_selem=self.mean_selem,
+                               scheduler=scheduler)
+        if self.bilateral_selem:
+            image = self._stage(bilateral_filter, image,
+                                selem_size=self.bilateral_selem,
+                                s0=self.s0, s1=self.s1,
+                                scheduler=self.scheduler)
+        if self.mean_selem:
+            image = self._stage(mean_filter, image,
+                                selem_size=self.mean_selem,
+                                scheduler=self.scheduler)
+        if self.threshold:
+            image = self._stage(otsu_threshold, image)
+        return image
+
+    def regions(self, binary):
+        "Extract regions from binary image, with well positions set."
+        regions = extract_regions(binary, self.max_regions)
+        if self.grid == 'lattice' and len(regions):
+            self.lattice = fit_lattice(regions)
+            return self.lattice.assign(regions)
+        return set_well_positions(regions)
+
+    def scaled(self, factor):
+        "Copy of pipeline with selem sizes scaled for a downsampled image."
+        pipeline = RegionPipeline(self.bilateral_selem, self.s0, self.s1,
+                                  self.mean_selem, self.threshold,
+                                  self.max_regions, self.scheduler,
+                                  self.fused, self.cache, self.grid)
+        if self.bilateral_selem:
+            pipeline.bilateral_selem = scale_selem(self.bilateral_selem, factor)
+        if self.mean_selem:
+            pipeline.mean_selem = scale_selem(self.mean_selem, factor)
+        return pipeline
+
+    def _downsampled(self, image, factor):
+        """Strided view of image. The view of the last image is reused, as
+        the cache is keyed on identity of the input."""
+        if (self._preview is None or self._preview[0] is not image or
+                self._preview[1] != factor):
+            # strided, as averaging would smooth out texture
+            self._preview = image, factor, image[::factor, ::factor]
+        return self._preview[2]
+
+    def preview(self, image, max_size=2048):
+        """Find regions on a downsampled pyramid level of the image, for
+        fast feedback while tuning parameters. Call the pipeline on the full
+        image to get the final regions.
+
+        Parameters
+        ----------
+        image : 2d array
+            Overview image.
+        max_size : int
+            Maximum side length of downsampled image.
+
+        Returns
+        -------
+        leicaautomator.regions.RegionTable
+            Regions in full resolution pixels, with ``well_x`` and
+            ``well_y``.
+        """
+        factor = preview_factor(image.shape, max_size)
+        pipeline = self.scaled(factor)
+        downsampled = self._downsampled(image, factor)
+        regions = pipeline.regions(pipeline.filter(downsampled))
+        regions.scale(factor)
+        if pipeline.lattice is not None:
+            self.lattice = fit_lattice(regions)
+        return regions
+
+    def __call__(self, image):
+        """Find regions in image.
+
+        Parameters
+        ----------
+        image : 2d array
+            Overview image.
+
+        Returns
+        -------
+        leicaautomator.regions.RegionTable
+            Regions with ``x``, ``y``, ``x_end``, ``y_end``, ``well_x`` and
+            ``well_y``.
+        """
+        return self.regions(self.filter(image))
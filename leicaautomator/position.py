@@ -4,12 +4,120 @@ Conversion between stage coordinate system and image pixels.
 
 from leicascanningtemplate import ScanningTemplate
 import numpy as np
-from skimage import io
 
+from .regions import RegionTable
+from .utils import _well_images, experiment_image_info
 
-def construct_stage_position(experiment, offset):
-    """Constructor for ``stage_position(pixel_position)`` which translates pixel
-    position to stage position.
+
+class AffineTransform(object):
+    """Affine transform of (y, x) coordinates, like pixel to stage
+    position. Applies to scalars or arrays of coordinates at once.
+
+    Parameters
+    ----------
+    matrix : 3x3 array, optional
+        Homogeneous transform matrix acting on ``(y, x, 1)``. Identity if
+        not given.
+
+    Example
+    -------
+    >>> t = AffineTransform.from_params(scale=(2, 3), offset=(10, 20))
+    >>> t([0, 1], [0, 1])
+    (array([10., 12.]), array([20., 23.]))
+    >>> t.inverse()(12, 23)
+    (1.0, 1.0)
+    """
+    def __init__(self, matrix=None):
+        if matrix is None:
+            matrix = np.eye(3)
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+
+    @classmethod
+    def from_params(cls, scale=(1, 1), offset=(0, 0), rotation=0, shear=0):
+        """Transform which scales, shears, rotates and then offsets.
+
+        Parameters
+        ----------
+        scale : tuple (y, x)
+            Scale of each axis.
+        offset : tuple (y, x)
+            Translation, added last.
+        rotation : float
+            Counter clockwise rotation in radians.
+        shear : float
+            Shear of x by y, in radians.
+        """
+        scaling = np.diag([scale[0], scale[1], 1.])
+        shearing = np.array([[1, 0, 0],
+                             [np.tan(shear), 1, 0],
+                             [0, 0, 1]])
+        cos, sin = np.cos(rotation), np.sin(rotation)
+        rotating = np.array([[cos, -sin, 0],
+                             [sin, cos, 0],
+                             [0, 0, 1]])
+        translating = np.array([[1, 0, offset[0]],
+                                [0, 1, offset[1]],
+                                [0, 0, 1]])
+        matrix = np.dot(translating, np.dot(rotating,
+                                            np.dot(shearing, scaling)))
+        return cls(matrix)
+
+    @property
+    def offset(self):
+        "Translation (y, x)."
+        return tuple(self.matrix[:2, 2])
+
+    def __call__(self, y, x):
+        """Transform coordinates.
+
+        Parameters
+        ----------
+        y, x : float or array
+            Coordinates, arrays of same shape.
+
+        Returns
+        -------
+        tuple (Y, X)
+            Transformed coordinates, same shape as input.
+        """
+        y = np.asarray(y, dtype=np.float64)
+        x = np.asarray(x, dtype=np.float64)
+        m = self.matrix
+        Y = m[0, 0]*y + m[0, 1]*x + m[0, 2]
+        X = m[1, 0]*y + m[1, 1]*x + m[1, 2]
+        if Y.ndim == 0:
+            return float(Y), float(X)
+        return Y, X
+
+    def apply(self, coords):
+        """Transform array of coordinates.
+
+        Parameters
+        ----------
+        coords : array (..., 2)
+            Coordinates as (y, x) in last dimension.
+
+        Returns
+        -------
+        array (..., 2)
+        """
+        coords = np.asarray(coords, dtype=np.float64)
+        return np.dot(coords, self.matrix[:2, :2].T) + self.matrix[:2, 2]
+
+    def compose(self, other):
+        "Transform which applies ``other`` first, then this transform."
+        return AffineTransform(np.dot(self.matrix, other.matrix))
+
+    def inverse(self):
+        "Inverse transform, like stage to pixel position."
+        return AffineTransform(np.linalg.inv(self.matrix))
+
+    def __repr__(self):
+        return 'AffineTransform(%r)' % self.matrix.tolist()
+
+
+def construct_stage_transform(experiment, offset):
+    """Transform from pixel position in stitched image to stage position.
 
     Parameters
     ----------
@@ -17,11 +125,17 @@ def construct_stage_position(experiment, offset):
         Stage displacement is read from this experiment.
     offset : tuple (y, x)
         Registered offset between images in pixels.
+
+    Returns
+    -------
+    AffineTransform
+        Pixel (y, x) to stage (Y, X) in meters.
     """
     # experiment must have 2 or more rows/columns
-    assert len(experiment.field_rows(0, 0)) > 1, \
+    fields = _well_images(experiment)[0, 0]
+    assert len(set(y for _, y, _ in fields)) > 1, \
             "Experiment must have 2 or more rows"
-    assert len(experiment.field_columns(0, 0)) > 1, \
+    assert len(set(x for _, _, x in fields)) > 1, \
             "Experiment must have 2 or more columns"
 
     # load template
@@ -32,7 +146,7 @@ def construct_stage_position(experiment, offset):
     yoffset, xoffset = offset
     y_distance = tmpl.properties.ScanFieldStageDistanceY * 1e-6 # in microns
     x_distance = tmpl.properties.ScanFieldStageDistanceX * 1e-6
-    img_shape = io.imread(experiment.images[0]).shape
+    img_shape, _ = experiment_image_info(experiment)
     # do not trust reported px size in TIF metadata
     y_px_size = y_distance / (yoffset % img_shape[0]) # wrap to positive
     x_px_size = x_distance / (xoffset % img_shape[1])
@@ -44,58 +158,70 @@ def construct_stage_position(experiment, offset):
     y_start = y_center - img_shape[0]//2 * y_px_size
     x_start = x_center - img_shape[1]//2 * x_px_size
 
+    return AffineTransform.from_params(scale=(y_px_size, x_px_size),
+                                       offset=(y_start, x_start))
+
+
+def construct_stage_position(experiment, offset):
+    """Constructor for ``stage_position(pixel_position)`` which translates pixel
+    position to stage position.
+
+    Parameters
+    ----------
+    experiment : leicaexperiment.Experiment
+        Stage displacement is read from this experiment.
+    offset : tuple (y, x)
+        Registered offset between images in pixels.
+    """
+    transform = construct_stage_transform(experiment, offset)
+
     def stage_position(y, x):
         """Get stage position by pixel coordinate.
 
         Parameters
         ----------
-        y : int
+        y : int or array
             Pixel y coordinate.
-        x : int
+        x : int or array
             Pixel x coordinate.
 
         Returns
         -------
         tuple (Y, X)
-            Stage position of pixel (y, x).
+            Stage position of pixel (y, x), arrays if input is arrays.
         """
-        return (y_start + y*y_px_size, x_start + x*x_px_size)
+        return transform(y, x)
 
+    stage_position.transform = transform
     return stage_position
 
 
-def mean_well_displacement(regions):
+def mean_well_displacement(regions, lattice=None):
     """Find mean well displacement.
 
     Parameters
     ----------
-    regions : skimage regionprops
-        Regions to find displacement between.
+    regions : RegionTable or list of skimage regionprops
+        Regions to find displacement between, with ``well_x``/``well_y``.
+    lattice : leicaautomator.lattice.Lattice, optional
+        Fitted lattice, its spacing is returned instead of measuring
+        regions.
 
     Returns
     -------
     list [y, x]
         Mean displacement between rows and columns.
     """
-    rows_cols = (sorted(set(r.well_y for r in regions)),
-                 sorted(set(r.well_x for r in regions)))
+    if lattice is not None:
+        return list(lattice.spacing)
+    regions = RegionTable.from_regions(regions)
 
     # same algorithm for x/y direction
     result = []
-    for i, p, w in [(0, 'y', 'well_y'), (1, 'x', 'well_x')]:
-        dxs = []
-        # median y/x-position of regions in first row/col
-        prev_median = _median(regions, p, w, rows_cols[i][0])
-        for x in rows_cols[i][1:]:
-            median = _median(regions, p, w, x)
-            dxs.append(median - prev_median)
-            prev_median = median
-
-        result.append(np.mean(dxs))
+    for p, w in [('y', 'well_y'), ('x', 'well_x')]:
+        # median y/x-position of regions in each row/col
+        medians = [np.median(regions[p][regions[w] == well])
+                   for well in np.unique(regions[w])]
+        result.append(np.mean(np.diff(medians)))
 
     return result
-
-
-def _median(regions, p, w, x):
-    "get median position for given row/col"
-    return np.median([getattr(r, p) for r in regions if getattr(r, w) == x])
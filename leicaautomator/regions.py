@@ -0,0 +1,347 @@
+"""
+Compact table of regions, one fixed width record per region.
+"""
+import numpy as np
+import scipy.ndimage as nd
+
+__all__ = ['RegionTable', 'Region', 'RegionIndex', 'REGION_DTYPE']
+
+# little endian to be portable between hosts when saved
+REGION_DTYPE = np.dtype([('label', '<i4'),
+                         ('y', '<i8'), ('x', '<i8'),
+                         ('y_end', '<i8'), ('x_end', '<i8'),
+                         ('centroid_y', '<f8'), ('centroid_x', '<f8'),
+                         ('area', '<i8'),
+                         ('well_x', '<i4'), ('well_y', '<i4')])
+
+
+def _field(name):
+    "Property of Region which reads and writes column of table."
+    def get(self):
+        return self.table.records[name][self.index].item()
+    def set(self, value):
+        self.table.records[name][self.index] = value
+    return property(get, set, doc='``%s`` of region.' % name)
+
+
+class Region(object):
+    """View of one row in a :class:`RegionTable`. Attributes read and write
+    the table, like ``region.x += 10``. A view refers to a row index, so it
+    is valid until rows are added, removed or reordered.
+    """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    label = _field('label')
+    y = _field('y')
+    x = _field('x')
+    y_end = _field('y_end')
+    x_end = _field('x_end')
+    area = _field('area')
+    well_x = _field('well_x')
+    well_y = _field('well_y')
+
+    @property
+    def bbox(self):
+        "(y, x, y_end, x_end), like skimage regionprops."
+        return (self.y, self.x, self.y_end, self.x_end)
+
+    @property
+    def centroid(self):
+        "(y, x) of center of mass."
+        row = self.table.records[self.index]
+        return (row['centroid_y'].item(), row['centroid_x'].item())
+
+    def __repr__(self):
+        return 'Region(label=%d, bbox=%r, well=(%d, %d))' % (
+            self.label, self.bbox, self.well_x, self.well_y)
+
+
+class RegionTable(object):
+    """Regions as struct of arrays, one record of :data:`REGION_DTYPE` per
+    region. Columns are accessed by name, rows as :class:`Region` views.
+
+    Parameters
+    ----------
+    records : array of REGION_DTYPE, optional
+        Regions, empty table if not given.
+
+    Example
+    -------
+    >>> regions = RegionTable.from_labels(labels, max_regions=129)
+    >>> regions['x'] # column
+    >>> regions[0].well_x # row
+    >>> [(r.well_x, r.well_y) for r in regions]
+    """
+    def __init__(self, records=None):
+        if records is None:
+            records = np.zeros(0, dtype=REGION_DTYPE)
+        self.records = records
+
+    @classmethod
+    def from_labels(cls, labels, max_regions=None):
+        """Measure regions in label image, largest first. The label image is
+        not referenced by the table.
+
+        Parameters
+        ----------
+        labels : 2d array int
+            Label image, background is 0.
+        max_regions : int, optional
+            Number of regions to keep.
+
+        Returns
+        -------
+        RegionTable
+        """
+        areas = np.bincount(labels.ravel())
+        areas[0] = 0
+        # largest first, ties in label order
+        order = np.argsort(-areas, kind='mergesort')
+        order = order[areas[order] > 0][:max_regions]
+
+        objects = nd.find_objects(labels)
+        records = np.zeros(len(order), dtype=REGION_DTYPE)
+        for i, label in enumerate(order):
+            y, x = objects[label-1]
+            ys, xs = np.nonzero(labels[y, x] == label)
+            records[i] = (label, y.start, x.start, y.stop, x.stop,
+                          ys.mean() + y.start, xs.mean() + x.start,
+                          areas[label], -1, -1)
+        return cls(records)
+
+    @classmethod
+    def from_regions(cls, regions):
+        """Table from objects with attributes ``y``, ``x``, ``y_end``,
+        ``x_end`` (or ``bbox``), and optionally ``label``, ``centroid``,
+        ``area``, ``well_x`` and ``well_y``, like skimage regionprops.
+
+        Parameters
+        ----------
+        regions : iterable
+
+        Returns
+        -------
+        RegionTable
+        """
+        if isinstance(regions, RegionTable):
+            return regions
+        if isinstance(regions, np.ndarray):
+            return cls(regions.astype(REGION_DTYPE, copy=False))
+        regions = list(regions)
+        records = np.zeros(len(regions), dtype=REGION_DTYPE)
+        for i, r in enumerate(regions):
+            try:
+                bbox = (r.y, r.x, r.y_end, r.x_end)
+            except AttributeError:
+                bbox = r.bbox
+            centroid = getattr(r, 'centroid', None)
+            if centroid is None:
+                centroid = ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+            records[i] = ((getattr(r, 'label', i+1),) + tuple(bbox) +
+                          tuple(centroid) +
+                          (getattr(r, 'area', 0), getattr(r, 'well_x', -1),
+                           getattr(r, 'well_y', -1)))
+        return cls(records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        for i in range(len(self.records)):
+            yield Region(self, i)
+
+    def __getitem__(self, key):
+        """Column by name, columns by list of names, row view by int, or new
+        table by slice, index array or boolean mask.
+        """
+        if isinstance(key, str) or (isinstance(key, list) and key and
+                                    isinstance(key[0], str)):
+            return self.records[key]
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError('region index out of range')
+            return Region(self, key)
+        return RegionTable(self.records[key])
+
+    def __repr__(self):
+        return 'RegionTable(%d regions)' % len(self)
+
+    def copy(self):
+        "Copy of table, in memory."
+        return RegionTable(np.array(self.records))
+
+    def index(self, label):
+        "Row index of region with label, ValueError if not found."
+        found = np.flatnonzero(self.records['label'] == label)
+        if not len(found):
+            raise ValueError('no region with label %s' % label)
+        return found[0]
+
+    def append(self, y, x, y_end, x_end, label=None, area=None,
+               centroid=None):
+        """Add region, returns view of the new row.
+
+        Parameters
+        ----------
+        y, x, y_end, x_end : int
+            Bounding box.
+        label : int, optional
+            Defaults to largest label + 1.
+        area : int, optional
+            Defaults to bounding box area.
+        centroid : tuple (y, x), optional
+            Defaults to center of bounding box.
+        """
+        if label is None:
+            label = self.records['label'].max() + 1 if len(self) else 1
+        if area is None:
+            area = (y_end - y) * (x_end - x)
+        if centroid is None:
+            centroid = ((y + y_end) / 2, (x + x_end) / 2)
+        record = np.array([(label, y, x, y_end, x_end, centroid[0],
+                            centroid[1], area, -1, -1)], dtype=REGION_DTYPE)
+        self.records = np.concatenate([self.records, record])
+        return Region(self, len(self) - 1)
+
+    def remove(self, label):
+        "Remove region with label."
+        self.records = np.delete(self.records, self.index(label))
+
+    def scale(self, factor):
+        "Scale coordinates and area in place, like from a downsampled image."
+        for name in ('y', 'x', 'y_end', 'x_end', 'centroid_y', 'centroid_x'):
+            self.records[name] *= factor
+        self.records['area'] *= factor**2
+        return self
+
+
+class RegionIndex(object):
+    """Spatial index of region bounding boxes, a hash of grid cells to the
+    regions overlapping them. Finding regions at a position only looks at
+    one cell, instead of all regions. Keep it up to date with
+    :meth:`insert`, :meth:`move` and :meth:`remove` when regions are edited.
+
+    Parameters
+    ----------
+    regions : RegionTable, optional
+        Regions to index, by label.
+    cell_size : int, optional
+        Side length of grid cells in pixels. Defaults to median region
+        size, so a region overlaps about four cells.
+
+    Example
+    -------
+    >>> index = RegionIndex(regions)
+    >>> index.at(y, x) # labels of regions containing pixel
+    >>> index.at_stage(Y, X, stage_position.transform)
+    """
+    def __init__(self, regions=None, cell_size=None):
+        regions = RegionTable.from_regions(regions if regions is not None
+                                           else [])
+        if cell_size is None:
+            sizes = np.maximum(regions['y_end'] - regions['y'],
+                               regions['x_end'] - regions['x'])
+            cell_size = np.median(sizes) if len(sizes) else 256
+        self.cell_size = max(int(cell_size), 1)
+        self.cells = {} # (row, column) -> set of labels
+        self.bboxes = {} # label -> (y, x, y_end, x_end)
+        for r in regions:
+            self.insert(r.label, r.bbox)
+
+    def __len__(self):
+        return len(self.bboxes)
+
+    def _cells(self, y, x, y_end, x_end):
+        "Cells covering bbox, edges included."
+        c = self.cell_size
+        for row in range(int(y // c), int(y_end // c) + 1):
+            for column in range(int(x // c), int(x_end // c) + 1):
+                yield row, column
+
+    def insert(self, label, bbox):
+        """Add region.
+
+        Parameters
+        ----------
+        label : int
+        bbox : tuple (y, x, y_end, x_end)
+        """
+        bbox = tuple(bbox)
+        self.bboxes[label] = bbox
+        for cell in self._cells(*bbox):
+            self.cells.setdefault(cell, set()).add(label)
+
+    def remove(self, label):
+        "Remove region, KeyError if not indexed."
+        for cell in self._cells(*self.bboxes.pop(label)):
+            labels = self.cells[cell]
+            labels.discard(label)
+            if not labels:
+                del self.cells[cell]
+
+    def move(self, label, bbox):
+        "Set new bbox of region."
+        self.remove(label)
+        self.insert(label, bbox)
+
+    def query(self, y, x, y_end, x_end):
+        """Regions which bbox touch a rectangle, edges included.
+
+        Returns
+        -------
+        list
+            Labels, sorted.
+        """
+        found = set()
+        for cell in self._cells(y, x, y_end, x_end):
+            found.update(self.cells.get(cell, ()))
+        return sorted(l for l in found
+                      if _touch(self.bboxes[l], (y, x, y_end, x_end)))
+
+    def at(self, y, x):
+        "Labels of regions containing pixel (y, x), edges included."
+        return self.query(y, x, y, x)
+
+    def at_stage(self, Y, X, transform):
+        """Labels of regions containing stage position.
+
+        Parameters
+        ----------
+        Y, X : float
+            Stage position.
+        transform : leicaautomator.position.AffineTransform
+            Pixel to stage transform, like ``stage_position.transform``.
+        """
+        return self.at(*transform.inverse()(Y, X))
+
+    def overlaps(self):
+        """Pairs of regions which overlap, bbox edges excluded.
+
+        Returns
+        -------
+        set of tuple (label, label)
+            Smallest label first.
+        """
+        pairs = set()
+        for labels in self.cells.values():
+            for a in labels:
+                for b in labels:
+                    if a < b and _overlap(self.bboxes[a], self.bboxes[b]):
+                        pairs.add((a, b))
+        return pairs
+
+
+def _touch(a, b):
+    "Whether bboxes intersect, edges included."
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def _overlap(a, b):
+    "Whether bboxes intersect, edges excluded."
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
@@ -0,0 +1,228 @@
+"""
+Plan the order regions are scanned in, to minimize stage travel.
+"""
+import numpy as np
+
+from .regions import RegionTable
+from .utils import _zick_zack_order
+
+__all__ = ['StageSpeed', 'Route', 'plan_route', 'travel_times']
+
+
+class StageSpeed(object):
+    """Time the stage needs to move. Axes move at the same time, each
+    accelerating to ``speed`` and decelerating again, so a move takes as
+    long as the slowest axis, plus ``settle`` time before imaging.
+
+    Defaults are rough guesses, measure the stage of your microscope.
+
+    Parameters
+    ----------
+    speed : float
+        Maximum speed in meters per second.
+    acceleration : float
+        Acceleration in meters per second squared.
+    settle : float
+        Seconds to wait after a move.
+    """
+    def __init__(self, speed=0.01, acceleration=0.05, settle=0.1):
+        self.speed = speed
+        self.acceleration = acceleration
+        self.settle = settle
+
+    def axis_time(self, distance):
+        "Seconds to move one axis ``distance`` meters, array or float."
+        distance = np.abs(distance)
+        v, a = self.speed, self.acceleration
+        # never reaches full speed on short moves
+        short = 2 * np.sqrt(distance / a)
+        full = distance / v + v / a
+        return np.where(distance < v**2 / a, short, full)
+
+    def __call__(self, dy, dx):
+        """Seconds to move (dy, dx) meters.
+
+        Parameters
+        ----------
+        dy, dx : float or array
+
+        Returns
+        -------
+        float or array
+        """
+        t = np.maximum(self.axis_time(dy), self.axis_time(dx))
+        return np.where((dy != 0) | (dx != 0), t + self.settle, 0.)
+
+    def __repr__(self):
+        return 'StageSpeed(speed=%s, acceleration=%s, settle=%s)' % (
+            self.speed, self.acceleration, self.settle)
+
+
+def travel_times(Y, X, speed=None):
+    """Matrix of travel times between all stage positions.
+
+    Parameters
+    ----------
+    Y, X : array
+        Stage positions in meters.
+    speed : StageSpeed, optional
+
+    Returns
+    -------
+    2d array
+        ``times[i, j]`` is seconds from position ``i`` to ``j``.
+    """
+    speed = speed or StageSpeed()
+    Y, X = np.asarray(Y, dtype=np.float64), np.asarray(X, dtype=np.float64)
+    return speed(Y[:, None] - Y[None, :], X[:, None] - X[None, :])
+
+
+class Route(object):
+    """Planned scan order of regions.
+
+    Attributes
+    ----------
+    order : array
+        Row indices of regions in scan order.
+    time : float
+        Predicted seconds of stage travel.
+    zick_zack_time : float
+        Predicted seconds of stage travel for regions sorted by
+        :func:`leicaautomator.utils.zick_zack_sort` on ``well_x``, ``well_y``.
+    """
+    def __init__(self, order, time, zick_zack_time):
+        self.order = order
+        self.time = time
+        self.zick_zack_time = zick_zack_time
+
+    @property
+    def saved(self):
+        "Predicted seconds saved compared to zick zack."
+        return self.zick_zack_time - self.time
+
+    def __call__(self, regions):
+        "Regions in scan order."
+        return regions[self.order]
+
+    def __repr__(self):
+        return 'Route(%d regions, time=%.1f s, zick_zack_time=%.1f s)' % (
+            len(self.order), self.time, self.zick_zack_time)
+
+
+def plan_route(regions, stage_position, speed=None, start=None):
+    """Plan scan order with short stage travel. The route starts with
+    nearest neighbours and is improved with 2-opt (reversing parts of it)
+    and Or-opt (moving up to three regions elsewhere) until neither helps.
+    Missing cores and irregular layouts are handled, as only the stage
+    position of each region is used.
+
+    Parameters
+    ----------
+    regions : RegionTable
+        Regions with bounding boxes in overview pixels.
+    stage_position : function
+        ``stage_position(y, x)`` which accepts arrays, see
+        :func:`leicaautomator.position.construct_stage_position`.
+    speed : StageSpeed, optional
+        Model of stage travel time.
+    start : tuple (Y, X), optional
+        Current stage position. If not given, the route starts at the first
+        region in zick zack order, as the zick zack route does.
+
+    Returns
+    -------
+    Route
+        Scan order and predicted travel time, compared with zick zack.
+
+    Example
+    -------
+    >>> route = plan_route(regions, stage_position)
+    >>> route.time, route.zick_zack_time
+    >>> ScanOrchestrator(template, route(regions), stage_position).scan()
+    """
+    regions = RegionTable.from_regions(regions)
+    n = len(regions)
+    if not n:
+        return Route(np.zeros(0, dtype=np.intp), 0., 0.)
+    Y, X = stage_position((regions['y'] + regions['y_end']) / 2,
+                          (regions['x'] + regions['x_end']) / 2)
+    Y, X = np.atleast_1d(Y), np.atleast_1d(X)
+    zick_zack = _zick_zack_order(regions, ('well_x', 'well_y'))
+
+    # node n is start position, node n+1 is a free end of the route
+    if start is None:
+        start = Y[zick_zack[0]], X[zick_zack[0]]
+    times = np.zeros((n + 2, n + 2))
+    times[:n+1, :n+1] = travel_times(np.append(Y, start[0]),
+                                     np.append(X, start[1]), speed)
+
+    path = _nearest_neighbour(times, n)
+    while _two_opt(times, path) | _or_opt(times, path):
+        pass
+
+    zick_zack_path = np.concatenate([[n], zick_zack, [n + 1]])
+    return Route(path[1:-1], _path_time(times, path),
+                 _path_time(times, zick_zack_path))
+
+
+def _path_time(times, path):
+    return float(times[path[:-1], path[1:]].sum())
+
+
+def _nearest_neighbour(times, start):
+    "Path from start visiting nearest unvisited node, free end last."
+    end = len(times) - 1
+    visited = np.zeros(len(times), dtype=bool)
+    visited[[start, end]] = True
+    path = [start]
+    for _ in range(len(times) - 2):
+        candidates = np.where(visited, np.inf, times[path[-1]])
+        path.append(int(np.argmin(candidates)))
+        visited[path[-1]] = True
+    path.append(end)
+    return np.array(path)
+
+
+def _two_opt(times, path, eps=1e-9):
+    "Reverse parts of path in place while it gets shorter."
+    improved = False
+    m = len(path)
+    for i in range(1, m - 2):
+        a, b = path[i-1], path[i]
+        c, d = path[i+1:-1], path[i+2:]
+        # reverse path[i:j+1], for all j > i at once
+        delta = times[a, c] + times[b, d] - times[a, b] - times[c, d]
+        j = np.argmin(delta)
+        if delta[j] < -eps:
+            j += i + 1
+            path[i:j+1] = path[i:j+1][::-1]
+            improved = True
+    return improved
+
+
+def _or_opt(times, path, eps=1e-9):
+    "Move segments of 1-3 nodes in place while path gets shorter."
+    improved = False
+    for length in (1, 2, 3):
+        i = 1
+        while i + length < len(path):
+            segment = path[i:i+length].copy()
+            first, last = segment[0], segment[-1]
+            before, after = path[i-1], path[i+length]
+            gain = (times[before, first] + times[last, after] -
+                    times[before, after])
+            rest = np.concatenate([path[:i], path[i+length:]])
+            q0, q1 = rest[:-1], rest[1:]
+            forward = times[q0, first] + times[last, q1] - times[q0, q1]
+            backward = times[q0, last] + times[first, q1] - times[q0, q1]
+            k_forward, k_backward = np.argmin(forward), np.argmin(backward)
+            if backward[k_backward] < forward[k_forward]:
+                k, cost, segment = k_backward, backward[k_backward], \
+                                   segment[::-1]
+            else:
+                k, cost = k_forward, forward[k_forward]
+            if cost < gain - eps:
+                path[:] = np.concatenate([rest[:k+1], segment, rest[k+1:]])
+                improved = True
+            i += 1
+    return improved
@@ -0,0 +1,459 @@
+"""
+Scan regions with the microscope through the CAM interface of LAS AF.
+"""
+import asyncio
+import os
+import re
+import time
+from copy import deepcopy
+from itertools import product
+
+import numpy as np
+from leicacam.cam import bytes_as_dict, tuples_as_bytes
+from leicascanningtemplate import ScanningTemplate
+
+from .tiling import plan_fields
+
+__all__ = ['ScanOrchestrator', 'write_template', 'batch_template',
+           'write_batch_template']
+
+# prepended to every command
+PREFIX = [('cli', 'leicaautomator'), ('app', 'matrix')]
+# messages are terminated by line endings or null bytes
+_TERMINATOR = re.compile(b'[\r\n\x00]+')
+
+
+def write_template(base, filename, start_y, start_x):
+    """Write scanning template with well (1, 1) moved to a stage position,
+    and validate the written file.
+
+    Parameters
+    ----------
+    base : str
+        Scanning template to start from.
+    filename : str
+        File to write.
+    start_y, start_x : float
+        Stage position of first field in meters.
+
+    Raises
+    ------
+    ValueError
+        If the written template does not have the first field at the start
+        position.
+    """
+    tmpl = ScanningTemplate(base)
+    tmpl.move_well(1, 1, start_x, start_y)
+    tmpl.write(filename)
+
+    field = ScanningTemplate(filename).field(1, 1, 1, 1)
+    if field is None or (abs(float(field.FieldXCoordinate) - start_x) > 1e-9 or
+                         abs(float(field.FieldYCoordinate) - start_y) > 1e-9):
+        raise ValueError('Template %s not written correctly' % filename)
+
+
+def _field_distance(tmpl):
+    "Stage distance (y, x) between fields of template in meters."
+    return (float(tmpl.properties.ScanFieldStageDistanceY) * 1e-6,
+            float(tmpl.properties.ScanFieldStageDistanceX) * 1e-6)
+
+
+def _stage_bbox(region, stage_position):
+    "Stage (Y, X, Y_end, X_end) of region bounding box in meters."
+    Y, X = stage_position(np.array([region.y, region.y, region.y_end,
+                                    region.y_end]),
+                          np.array([region.x, region.x_end, region.x,
+                                    region.x_end]))
+    return Y.min(), X.min(), Y.max(), X.max()
+
+
+def _label(labels, index):
+    "Well label of template, or number if template has too few labels."
+    return str(labels[index]) if index < len(labels) else str(index + 1)
+
+
+def _add_well(tmpl, base_well, base_field, well, start, fields):
+    """Append well with a full grid of fields to template. Fields of the
+    grid which are not in ``fields`` are disabled, as LAS AF finds fields
+    by their position in the grid.
+
+    Parameters
+    ----------
+    tmpl : ScanningTemplate
+    base_well, base_field : lxml element
+        Copied for new well and fields.
+    well : tuple (well_x, well_y)
+        1-indexed.
+    start : tuple (Y, X)
+        Stage position of field (1, 1) in meters.
+    fields : list of tuple (field_y, field_x)
+        0-indexed fields to scan.
+    """
+    well_x, well_y = well
+    distance = _field_distance(tmpl)
+    count_x = max(f[1] for f in fields) + 1
+    count_y = max(f[0] for f in fields) + 1
+    element = deepcopy(base_well)
+    element.attrib['WellX'] = str(well_x)
+    element.attrib['WellY'] = str(well_y)
+    element.attrib['FieldXStartCoordinate'] = repr(start[1])
+    element.attrib['FieldYStartCoordinate'] = repr(start[0])
+    element.attrib['XCountOfFields'] = str(count_x)
+    element.attrib['YCountOfFields'] = str(count_y)
+    tmpl.well_array.append(element)
+
+    label_x = _label(tmpl.properties.TextWellPlateHorizontal[:], well_x - 1)
+    label_y = _label(tmpl.properties.TextWellPlateVertical[:], well_y - 1)
+    enabled = set(fields)
+    # column by column, as LAS AF writes them
+    for field_x, field_y in product(range(count_x), range(count_y)):
+        field = deepcopy(base_field)
+        field.FieldXCoordinate = start[1] + field_x * distance[1]
+        field.FieldYCoordinate = start[0] + field_y * distance[0]
+        field.attrib['WellX'] = str(well_x)
+        field.attrib['WellY'] = str(well_y)
+        field.attrib['FieldX'] = str(field_x + 1)
+        field.attrib['FieldY'] = str(field_y + 1)
+        field.attrib['LabelX'] = label_x
+        field.attrib['LabelY'] = label_y
+        field.attrib['Enabled'] = 'true' if (field_y, field_x) in enabled \
+                                  else 'false'
+        tmpl.field_array.append(field)
+
+
+def batch_template(base, regions, stage_position, binary=None,
+                   min_tissue=0.):
+    """Scanning template with one well per region, so all regions are
+    scanned with one load and one start of scan. Each well is as many
+    fields as needed to cover the region bounding box, with settings of the
+    first well and field in ``base``. If ``binary`` is given, fields
+    without tissue are disabled.
+
+    Wells are numbered by ``well_x`` and ``well_y`` of regions, so images
+    are saved in a chamber folder per core, and are in the template in the
+    order of ``regions``.
+
+    Parameters
+    ----------
+    base : str
+        Scanning template to start from.
+    regions : iterable
+        Regions with ``y``, ``x``, ``y_end``, ``x_end``, ``label``,
+        ``well_x`` and ``well_y``, like the output of
+        :class:`leicaautomator.viewer.RegionPlugin`.
+    stage_position : function
+        ``stage_position(y, x)`` which accepts arrays, see
+        :func:`leicaautomator.position.construct_stage_position`.
+    binary : 2d array bool, optional
+        Tissue in same pixels as regions, like ``RegionPipeline.filter``.
+        Fields without tissue are disabled, see
+        :func:`leicaautomator.tiling.plan_fields`.
+    min_tissue : float
+        Fraction of field which must be tissue, when ``binary`` is given.
+
+    Returns
+    -------
+    ScanningTemplate
+        Not written, see :func:`write_batch_template`.
+
+    Raises
+    ------
+    ValueError
+        If a region has no well position, or regions share a well.
+    """
+    tmpl = ScanningTemplate(base)
+    distance = _field_distance(tmpl)
+    base_well, base_field = deepcopy(tmpl.wells[0]), deepcopy(tmpl.fields[0])
+    for well in tmpl.wells:
+        tmpl.well_array.remove(well)
+    for field in tmpl.fields:
+        tmpl.field_array.remove(field)
+
+    wells = set()
+    for region in regions:
+        well = (region.well_x + 1, region.well_y + 1)
+        if min(well) < 1:
+            raise ValueError('Region %d has no well position, see '
+                             'set_well_positions' % region.label)
+        if well in wells:
+            raise ValueError('Several regions in well %s' % (well,))
+        wells.add(well)
+
+        if binary is not None:
+            start, fields = plan_fields(region, binary, stage_position,
+                                        distance, min_tissue)
+        else:
+            Y, X, Y_end, X_end = _stage_bbox(region, stage_position)
+            counts = [max(int(np.ceil(size / d - 1e-9)), 1) for size, d in
+                      zip((Y_end - Y, X_end - X), distance)]
+            fields = [(i, j) for i in range(counts[0])
+                      for j in range(counts[1])]
+            start = (Y + distance[0] / 2, X + distance[1] / 2)
+        _add_well(tmpl, base_well, base_field, well, start, fields)
+
+    tmpl.properties.EnableIndividualWellScanFieldCount = 'true'
+    return tmpl
+
+
+def write_batch_template(base, filename, regions, stage_position,
+                         **kwargs):
+    """Write :func:`batch_template` and validate the written file.
+
+    Parameters
+    ----------
+    base, regions, stage_position, kwargs
+        See :func:`batch_template`.
+    filename : str
+        File to write.
+
+    Returns
+    -------
+    ScanningTemplate
+
+    Raises
+    ------
+    ValueError
+        If the written template does not have the fields of the regions.
+    """
+    tmpl = batch_template(base, regions, stage_position, **kwargs)
+    tmpl.write(filename)
+
+    def coordinates(t):
+        return np.array([(float(f.FieldYCoordinate), float(f.FieldXCoordinate))
+                         for f in t.fields]).reshape(-1, 2)
+    expected = coordinates(tmpl)
+    written = ScanningTemplate(filename)
+    if (len(written.wells) != len(tmpl.wells) or
+            not np.allclose(coordinates(written), expected, rtol=0,
+                            atol=1e-9)):
+        raise ValueError('Template %s not written correctly' % filename)
+    return tmpl
+
+
+class ScanOrchestrator(object):
+    """Scan regions one by one, each region as well (1, 1) of a scanning
+    template. The template of next region is written while current region
+    is scanning, and CAM messages are awaited as they arrive, so the
+    microscope is not idle between regions.
+
+    Templates alternate between two names, as LAS AF does not reload a
+    template with the same name. With ``batch=True`` all regions are wells
+    of one template, see :func:`batch_template`, and scanned with one load
+    and one start of scan.
+
+    Parameters
+    ----------
+    template : str
+        Scanning template to scan regions with.
+    regions : iterable
+        Regions in scan order, with ``y``, ``x``, ``label``, ``well_x`` and
+        ``well_y``, like a RegionTable.
+    stage_position : function
+        ``stage_position(y, x)`` which returns stage position (Y, X) in
+        meters of a pixel, see
+        :func:`leicaautomator.position.construct_stage_position`.
+    template_dir : str, optional
+        Folder of LAS AF scanning templates, defaults to folder of
+        ``template``.
+    name : str
+        Name of written templates, ``{ScanningTemplate}name0.xml`` and
+        ``{ScanningTemplate}name1.xml``.
+    host, port : str, int
+        CAM server.
+    finished : tuple (key, value)
+        Message which tells that a scan is finished.
+    timeout : float
+        Seconds to wait for a message before giving up.
+    batch : bool
+        Scan all regions with one template.
+    binary : 2d array bool, optional
+        Tissue of regions, to disable fields without tissue in batch
+        templates, see :func:`batch_template`.
+
+    Attributes
+    ----------
+    timings : list of dict
+        One dict per scanned template with ``labels`` and ``wells`` of the
+        regions in it, ``prepare``
+        (seconds writing template), ``idle`` (seconds from previous scan
+        finished to this scan started), ``scan`` (seconds scanning),
+        ``images`` (count of images saved), and ``ready``, ``loaded``,
+        ``started``, ``finished`` (seconds since start).
+
+    Example
+    -------
+    >>> orchestrator = ScanOrchestrator(template, regions, stage_position)
+    >>> orchestrator.scan()
+    >>> [t['idle'] for t in orchestrator.timings]
+    """
+    def __init__(self, template, regions, stage_position, template_dir=None,
+                 name='leicaautomator', host='127.0.0.1', port=8895,
+                 finished=('inf', 'scanfinished'), timeout=3600,
+                 batch=False, binary=None):
+        self.template = template
+        self.regions = list(regions)
+        self.stage_position = stage_position
+        self.template_dir = template_dir or os.path.dirname(template)
+        self.name = name
+        self.host = host
+        self.port = port
+        self.finished = finished
+        self.timeout = timeout
+        self.batch = batch
+        self.binary = binary
+        self.buffer_size = 1024
+        self.timings = []
+        self._waiters = []
+        self._images = 0
+
+    @property
+    def groups(self):
+        "Regions of each template, in scan order."
+        if self.batch:
+            return [self.regions] if self.regions else []
+        return [[r] for r in self.regions]
+
+    def filename(self, index):
+        "Template filename of template number ``index``."
+        return os.path.join(self.template_dir, '{ScanningTemplate}%s%d.xml'
+                            % (self.name, index % 2))
+
+    def _start_position(self, region):
+        "Stage position of first field, centered in top left of region."
+        tmpl = ScanningTemplate(self.template)
+        y_distance = float(tmpl.properties.ScanFieldStageDistanceY) * 1e-6
+        x_distance = float(tmpl.properties.ScanFieldStageDistanceX) * 1e-6
+        y, x = self.stage_position(region.y, region.x)
+        return y + y_distance / 2, x + x_distance / 2
+
+    def _prepare(self, index):
+        "Write template number ``index``, returns start and end time."
+        start = time.monotonic()
+        group = self.groups[index]
+        if self.batch:
+            write_batch_template(self.template, self.filename(index), group,
+                                 self.stage_position, binary=self.binary)
+        else:
+            write_template(self.template, self.filename(index),
+                           *self._start_position(group[0]))
+        return start, time.monotonic()
+
+    async def connect(self):
+        "Connect to CAM server and start reading messages."
+        self.reader, self.writer = await asyncio.open_connection(self.host,
+                                                                 self.port)
+        self._reader_task = asyncio.ensure_future(self._read())
+
+    def close(self):
+        "Close connection."
+        self._reader_task.cancel()
+        self.writer.close()
+
+    async def _read(self):
+        "Read messages and hand them to waiters."
+        buffer = b''
+        while True:
+            data = await self.reader.read(self.buffer_size)
+            if not data:
+                break
+            buffer += data
+            lines = _TERMINATOR.split(buffer)
+            buffer = lines.pop()
+            for line in lines:
+                if line:
+                    self._dispatch(bytes_as_dict(line))
+        for _, _, future in self._waiters:
+            if not future.done():
+                future.set_exception(ConnectionError('CAM server closed'))
+
+    def _dispatch(self, message):
+        if 'relpath' in message:
+            self._images += 1
+        for waiter in list(self._waiters):
+            key, value, future = waiter
+            if (message.get(key) == value if value else message.get(key)):
+                self._waiters.remove(waiter)
+                if not future.done():
+                    future.set_result(message)
+
+    def expect(self, key, value=None):
+        """Future of next message with ``key:value``. Call before sending
+        the command which triggers the message, so it is not missed.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append((key, value, future))
+        return future
+
+    async def send(self, commands):
+        "Send list of (key, value) commands."
+        self.writer.write(tuples_as_bytes(PREFIX + commands))
+        await self.writer.drain()
+
+    async def command(self, commands, key, value=None):
+        "Send commands and wait for reply ``key:value``."
+        reply = self.expect(key, value)
+        await self.send(commands)
+        return await asyncio.wait_for(reply, self.timeout)
+
+    async def run(self):
+        "Scan all regions, see :meth:`scan`."
+        loop = asyncio.get_event_loop()
+        clock = lambda: time.monotonic() - start
+        start = time.monotonic()
+        await self.connect()
+        groups = self.groups
+        try:
+            if not groups:
+                return self.timings
+            preparing = loop.run_in_executor(None, self._prepare, 0)
+            previous = None
+            for index, group in enumerate(groups):
+                prepare_start, prepare_end = await preparing
+                prepare = prepare_end - prepare_start
+                ready = prepare_end - start
+
+                basename = os.path.basename(self.filename(index))[:-4]
+                await self.command([('sys', '0'), ('cmd', 'load'),
+                                    ('fil', basename)], 'cmd', 'load')
+                loaded = clock()
+
+                finished = self.expect(*self.finished)
+                self._images = 0
+                await self.command([('cmd', 'startscan')], 'cmd', 'startscan')
+                started = clock()
+
+                # next template while scanning
+                if index + 1 < len(groups):
+                    preparing = loop.run_in_executor(None, self._prepare,
+                                                     index + 1)
+                await asyncio.wait_for(finished, self.timeout)
+                done = clock()
+
+                self.timings.append({
+                    'labels': [r.label for r in group],
+                    'wells': [(r.well_x, r.well_y) for r in group],
+                    'prepare': prepare,
+                    'idle': started - (previous if previous is not None
+                                       else 0),
+                    'scan': done - started,
+                    'images': self._images,
+                    'ready': ready, 'loaded': loaded,
+                    'started': started, 'finished': done})
+                previous = done
+        finally:
+            self.close()
+        return self.timings
+
+    def scan(self):
+        """Scan all regions, blocks until done.
+
+        Returns
+        -------
+        list of dict
+            Timings, see class documentation.
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.run())
+        finally:
+            loop.close()
@@ -0,0 +1,271 @@
+"""
+Stitching and region finding while the overview scan is still running.
+"""
+import glob
+import os
+import time
+
+import numpy as np
+from leicaexperiment import Experiment, attributes
+from leicascanningtemplate import ScanningTemplate
+from skimage.io import imread
+
+from .filters import otsu_from_histogram, _get_out_type
+from .pipeline import RegionPipeline, _fused_tile, _bincount
+from .regions import RegionTable
+from .utils import _translation, map_tiles
+
+__all__ = ['IncrementalStitcher']
+
+# first channel of every field in a well
+FIELD_PATTERN = os.path.join('slide--S*', 'chamber--U{u:02d}--V{v:02d}',
+                             'field--X*--Y*', 'image--*--C00.*')
+
+
+def _template_grid(path):
+    "Number of field (rows, columns) in scanning template of experiment."
+    tmpl = ScanningTemplate(Experiment(path).scanning_template)
+    return (int(tmpl.properties.CountOfScanFieldsY),
+            int(tmpl.properties.CountOfScanFieldsX))
+
+
+class IncrementalStitcher(object):
+    """Stitch fields of an experiment as they are written by the microscope,
+    and keep region candidates up to date. Each new field is registered to
+    its neighbours and blended into the overview. Only the part of the
+    filtered image which the field affects is filtered again, so regions
+    are ready right after the last field is written. When the offset
+    changes, the whole overview is filtered again once the offset is
+    unchanged for one field, or on next :meth:`regions`.
+
+    Regions are found as with ``RegionPipeline(fused=True)``.
+
+    Parameters
+    ----------
+    path : str
+        Path to experiment, containing ``slide--S00``.
+    grid : tuple (rows, columns), optional
+        Number of fields, read from the scanning template if not given.
+    offset : tuple (y, x), optional
+        Known offset between fields. If not given, it is the median of
+        registered neighbours, and the overview is blended again when the
+        median changes.
+    well : tuple (u, v)
+        Well to stitch.
+    pipeline : leicaautomator.pipeline.RegionPipeline, optional
+        Filter parameters.
+
+    Example
+    -------
+    >>> stitcher = IncrementalStitcher('experiment--overview')
+    >>> for added in stitcher.watch(timeout=3600):
+    ...     print(len(stitcher.regions()))
+    """
+    def __init__(self, path, grid=None, offset=None, well=(0, 0),
+                 pipeline=None):
+        self.path = path
+        self.grid = grid or _template_grid(path)
+        self.well = well
+        self.pipeline = pipeline or RegionPipeline()
+        self.fixed_offset = offset
+        self.offset = None
+        self.fields = {}  # (row, column) -> path
+        self.translations = {'y': [], 'x': []}
+        self.field_shape = None
+        self.image = None
+        self.smoothed = None
+        self._stale = False
+        self._sizes = {}
+
+    @property
+    def depth(self):
+        "Distance a pixel affects the smoothed image."
+        return self.pipeline.bilateral_selem//2 + self.pipeline.mean_selem//2
+
+    def add(self, path, row, column):
+        """Add field to overview.
+
+        Parameters
+        ----------
+        path : str
+            Image of field.
+        row, column : int
+            Field position, 0-indexed.
+        """
+        if self.field_shape is None:
+            self.field_shape = imread(path).shape[:2]
+        self.fields[row, column] = path
+
+        # register with neighbours, in whatever order they were scanned
+        for direction, first, second in (
+                ('y', (row-1, column), (row, column)),
+                ('y', (row, column), (row+1, column)),
+                ('x', (row, column-1), (row, column)),
+                ('x', (row, column), (row, column+1))):
+            if first in self.fields and second in self.fields:
+                pair = (self.fields[first], self.fields[second])
+                self.translations[direction].append(_translation(pair))
+
+        offset = self._estimate_offset()
+        if offset is None:
+            return # wait for more fields
+        if offset != self.offset:
+            self.offset = offset
+            self._reset()
+        else:
+            self._blend(row, column, path)
+
+    def _estimate_offset(self):
+        "Current offset, None if not yet registered in both directions."
+        if self.fixed_offset is not None:
+            return tuple(int(round(o)) for o in self.fixed_offset)
+        offset = []
+        for axis, direction in enumerate('yx'):
+            translations = self.translations[direction]
+            if translations:
+                median = np.median([t[axis] for t in translations])
+                offset.append(int(round(median)))
+            elif self.grid[axis] == 1:
+                offset.append(0)
+            else:
+                return None
+        return tuple(offset)
+
+    def _field_slice(self, row, column):
+        height, width = self.field_shape
+        y = row * (height + self.offset[0])
+        x = column * (width + self.offset[1])
+        return slice(y, y + height), slice(x, x + width)
+
+    def _reset(self):
+        "Allocate overview for current offset and blend all fields."
+        height, width = self.field_shape
+        rows, columns = self.grid
+        shape = (height + (height + self.offset[0]) * (rows-1),
+                 width + (width + self.offset[1]) * (columns-1))
+        dtype = imread(next(iter(self.fields.values()))).dtype
+        self._total = np.zeros(shape, dtype=np.uint32)
+        self._count = np.zeros(shape, dtype=np.uint8)
+        self.image = np.zeros(shape, dtype=dtype)
+        self.smoothed = np.zeros(shape, dtype=_get_out_type(
+                                 self.pipeline.bilateral_selem, 1))
+        for (row, column), path in self.fields.items():
+            self._add_to_overview(row, column, path)
+        # offset may change again, filter when regions are needed
+        self._stale = True
+
+    def _add_to_overview(self, row, column, path):
+        "Blend field into overview, seams are averaged."
+        rect = self._field_slice(row, column)
+        self._total[rect] += imread(path)
+        self._count[rect] += 1
+        self.image[rect] = self._total[rect] // self._count[rect]
+        return rect
+
+    def _blend(self, row, column, path):
+        rect = self._add_to_overview(row, column, path)
+        if self._stale: # offset unchanged since reset, filter all once
+            self._refilter()
+        else:
+            self._update(rect)
+
+    def _refilter(self):
+        "Filter whole overview."
+        p = self.pipeline
+        hists = map_tiles(_fused_tile, self.image, self.smoothed,
+                          depth=self.depth, partial=_bincount,
+                          extra_arguments=(p.bilateral_selem, p.s0, p.s1,
+                                           p.mean_selem))
+        self.hist = np.zeros(p.bilateral_selem**2 + 1, dtype=np.int64)
+        for h in hists:
+            self.hist[:len(h)] += h
+        self._stale = False
+
+    def _update(self, rect):
+        "Filter again the part of smoothed image affected by rect."
+        if self._stale:
+            return
+        d = self.depth
+        shape = self.image.shape
+        inner = tuple(slice(max(s.start - d, 0), min(s.stop + d, n))
+                      for s, n in zip(rect, shape))
+        outer = tuple(slice(max(s.start - d, 0), min(s.stop + d, n))
+                      for s, n in zip(inner, shape))
+        trim = tuple(slice(i.start - o.start, i.stop - o.start)
+                     for i, o in zip(inner, outer))
+        p = self.pipeline
+        new = _fused_tile(self.image[outer], p.bilateral_selem, p.s0, p.s1,
+                          p.mean_selem)[trim]
+        bins = len(self.hist)
+        self.hist -= np.bincount(self.smoothed[inner].ravel(), minlength=bins)
+        self.hist += np.bincount(new.ravel(), minlength=bins)
+        self.smoothed[inner] = new
+
+    def regions(self):
+        """Region candidates of fields added so far.
+
+        Returns
+        -------
+        leicaautomator.regions.RegionTable
+            Regions with ``x``, ``y``, ``x_end``, ``y_end``, ``well_x`` and
+            ``well_y``, found as in ``pipeline.regions``. Empty if offset is
+            not yet known.
+        """
+        if self.smoothed is None:
+            return RegionTable()
+        if self._stale:
+            self._refilter()
+        binary = self.smoothed >= otsu_from_histogram(self.hist)
+        return self.pipeline.regions(binary)
+
+    def poll(self):
+        """Add new fields in experiment folder. A file is added when its
+        size is unchanged since previous poll, so it is completely written.
+
+        Returns
+        -------
+        list
+            Paths of added fields.
+        """
+        u, v = self.well
+        pattern = os.path.join(self.path, FIELD_PATTERN.format(u=u, v=v))
+        added = []
+        for path in sorted(glob.glob(pattern)):
+            attr = attributes(path)
+            if (attr.y, attr.x) in self.fields:
+                continue
+            size = os.path.getsize(path)
+            if not size or self._sizes.get(path) != size:
+                self._sizes[path] = size
+                continue
+            self.add(path, attr.y, attr.x)
+            added.append(path)
+        return added
+
+    def watch(self, interval=0.5, timeout=None, fields=None):
+        """Poll experiment folder until all fields are added.
+
+        Parameters
+        ----------
+        interval : float
+            Seconds between polls.
+        timeout : float, optional
+            Stop after this many seconds.
+        fields : int, optional
+            Number of fields to wait for, defaults to rows*columns of grid.
+
+        Yields
+        ------
+        list
+            Paths of fields added since previous yield.
+        """
+        fields = fields or self.grid[0] * self.grid[1]
+        start = time.time()
+        while len(self.fields) < fields:
+            added = self.poll()
+            if added:
+                yield added
+            if timeout is not None and time.time() - start > timeout:
+                return
+            if len(self.fields) < fields:
+                time.sleep(interval)
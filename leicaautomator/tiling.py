@@ -0,0 +1,119 @@
+"""
+Cover regions with as few scan fields as possible.
+"""
+import numpy as np
+import scipy.ndimage as nd
+
+__all__ = ['plan_fields', 'region_mask']
+
+
+def region_mask(region, binary):
+    """Tissue of region, the largest connected object in its bounding box.
+    Corners of neighbour regions reaching into the bounding box are left
+    out.
+
+    Parameters
+    ----------
+    region : Region
+        Region with ``y``, ``x``, ``y_end`` and ``x_end``.
+    binary : 2d array bool
+        Tissue in same pixels as region, like ``RegionPipeline.filter``.
+
+    Returns
+    -------
+    2d array bool
+        Mask of bounding box.
+    """
+    crop = binary[region.y:region.y_end, region.x:region.x_end]
+    labels, count = nd.label(crop, structure=np.ones((3, 3)))
+    if not count:
+        # no tissue found, cover whole bounding box
+        return np.ones(crop.shape, dtype=bool)
+    areas = np.bincount(labels.ravel())
+    areas[0] = 0
+    return labels == np.argmax(areas)
+
+
+def _tissue_per_field(mask, size, offset):
+    "Tissue pixels in grid cells of ``size`` starting at ``-offset``."
+    tissue = mask.astype(np.intp)
+    for axis in (0, 1):
+        length = mask.shape[axis]
+        n = int(np.ceil((length + offset[axis]) / size[axis]))
+        # pixel p is in the cell which contains position p
+        edges = np.ceil(np.arange(n) * size[axis] - offset[axis])
+        edges = np.maximum(edges, 0).astype(int)
+        # last cell may start at the end of mask, it has no pixels
+        edges = edges[edges < length]
+        tissue = np.add.reduceat(tissue, edges, axis=axis)
+    return tissue
+
+
+def plan_fields(region, binary, stage_position, distance, min_tissue=0.,
+                steps=4):
+    """Fields covering the tissue of a region. A grid of fields is laid
+    over the region, and only fields with tissue are kept, so empty
+    corners of round cores are not scanned. The grid is shifted in
+    ``steps`` fractions of a field along each axis, and the shift with
+    fewest fields is used.
+
+    Parameters
+    ----------
+    region : Region
+        Region with ``y``, ``x``, ``y_end`` and ``x_end``.
+    binary : 2d array bool
+        Tissue in same pixels as region, like ``RegionPipeline.filter``.
+    stage_position : function
+        ``stage_position(y, x)`` which accepts arrays, see
+        :func:`leicaautomator.position.construct_stage_position`.
+    distance : tuple (Y, X)
+        Stage distance between fields in meters, like
+        ``ScanFieldStageDistanceY/X`` of the scanning template.
+    min_tissue : float
+        Fraction of field which must be tissue for the field to be kept.
+        With 0, any tissue is enough.
+    steps : int
+        Number of grid shifts to try along each axis.
+
+    Returns
+    -------
+    start : tuple (Y, X)
+        Stage position of field (0, 0) in meters.
+    fields : list of tuple (field_y, field_x)
+        Fields to scan, 0-indexed and stepping ``distance`` in positive
+        stage direction.
+
+    Example
+    -------
+    >>> binary = pipeline.filter(image)
+    >>> start, fields = plan_fields(regions[0], binary, stage_position,
+    ...                             (1500e-6, 1500e-6))
+    """
+    mask = region_mask(region, binary)
+    # field size in pixels, axes are assumed parallel to stage
+    origin = np.array(stage_position(0., 0.), dtype=np.float64)
+    pixel = np.abs([np.array(stage_position(1., 0.))[0] - origin[0],
+                    np.array(stage_position(0., 1.))[1] - origin[1]])
+    size = np.maximum(np.array(distance) / pixel, 1)
+
+    best = None
+    for oy in np.arange(steps) * size[0] / steps:
+        for ox in np.arange(steps) * size[1] / steps:
+            tissue = _tissue_per_field(mask, size, (oy, ox))
+            keep = tissue > min_tissue * size[0] * size[1]
+            if not keep.any():
+                keep = tissue == tissue.max()
+            if best is None or keep.sum() < best[0].sum():
+                best = keep, (oy, ox)
+    keep, offset = best
+
+    # field centers in pixels, then stage
+    rows, columns = np.nonzero(keep)
+    y = region.y - offset[0] + (rows + 0.5) * size[0]
+    x = region.x - offset[1] + (columns + 0.5) * size[1]
+    Y, X = stage_position(y, x)
+    Y, X = np.atleast_1d(Y), np.atleast_1d(X)
+    start = (Y.min(), X.min())
+    field_y = np.rint((Y - start[0]) / distance[0]).astype(int)
+    field_x = np.rint((X - start[1]) / distance[1]).astype(int)
+    return start, list(zip(field_y.tolist(), field_x.tolist()))
@@ -1,46 +1,59 @@
 import json
+import os
 import numpy
-import pickle
-import zlib
-from io import StringIO
+import struct
+import tempfile
 from operator import attrgetter
 
-from microscopestitching import stitch as mstitch
 from leicaexperiment import Experiment, attributes
-from warnings import warn, filterwarnings, catch_warnings
+from warnings import filterwarnings, catch_warnings
 
 from math import ceil
 from multiprocessing import cpu_count
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import product
+from functools import lru_cache
+from threading import Lock
+import atexit
+import weakref
 import dask.array as da
 
+from .regions import RegionTable
 
-def _getattr(o, k):
-    if 'image' in k or k[0] == '_':
-        return None
-    try:
-        v = o[k]
-        if type(v) == numpy.ndarray:
-            v = v.tolist()
-        return v
-    except KeyError:
-        return None
 
+def save_regions(filename, regions):
+    """Save regions as ``.npy`` file of
+    :data:`leicaautomator.regions.REGION_DTYPE` records.
 
-def _get(region):
-    r = {}
-    for k in region.__dict__:
-        v = _getattr(region, k)
-        if v is not None:
-            r[k] = v
-    return r
+    Parameters
+    ----------
+    filename : str
+        File to write, ``.npy`` is appended if missing.
+    regions : RegionTable or list of skimage.regionprops
+        See :meth:`leicaautomator.regions.RegionTable.from_regions`.
+    """
+    records = RegionTable.from_regions(regions).records
+    numpy.save(filename, records, allow_pickle=False)
 
 
-def save_regions(filename, regions):
-    "Save regions as compressed (gzip) pickle."
-    with open(filename, 'wb') as f:
-        out = pickle.dumps(regions)
-        out = zlib.compress(out)
-        f.write(out)
+def load_regions(filename, mmap_mode='r'):
+    """Load regions saved with :func:`save_regions`.
+
+    Parameters
+    ----------
+    filename : str
+        ``.npy`` file.
+    mmap_mode : str or None
+        Memory map file, see :func:`numpy.load`. ``None`` reads into memory.
+
+    Returns
+    -------
+    RegionTable
+        Regions, columns accessed by name, like ``regions['well_x']``.
+    """
+    return RegionTable(numpy.load(filename, mmap_mode=mmap_mode,
+                                  allow_pickle=False))
 
 
 def flatten(iterable):
@@ -63,19 +76,23 @@ def zick_zack_sort(list_, sortby):
 
     Parameters
     ----------
-    list_ : list
-        List of objects to sort.
+    list_ : list or RegionTable
+        List of objects to sort, sorted in place. A RegionTable is not
+        modified.
     sortby : iterable
-        Attributes in object to sort by.
+        Attributes in object, or columns in table, to sort by.
 
     Returns
     -------
-    list
+    list or RegionTable
         Sorted in zick zack.
     """
     if type(sortby) is str:
         sortby = (sortby,)
 
+    if isinstance(list_, RegionTable):
+        return list_[_zick_zack_order(list_, sortby)]
+
     list_.sort(key=attrgetter(*sortby))
     
     firstgetter = attrgetter(sortby[0])
@@ -99,45 +116,148 @@ def zick_zack_sort(list_, sortby):
     return out
 
 
-def _get_chunks(shape, ncpu):
-    """
-    Split the array into equal sized chunks based on the number of
-    available processors. The last chunk in each dimension absorbs the
-    remainder array elements if the number of cpus does not divide evenly into
-    the number of array elements.
-    >>> _get_chunks((4, 4), 4)
-    ((2, 2), (2, 2))
-    >>> _get_chunks((4, 4), 2)
-    ((2, 2), (4,))
-    >>> _get_chunks((5, 5), 2)
-    ((2, 3), (5,))
-    >>> _get_chunks((2, 4), 2)
-    ((1, 1), (4,))
+def _zick_zack_order(table, sortby):
+    "Row order of zick_zack_sort for a RegionTable."
+    # lexsort sorts by last key first
+    order = numpy.lexsort([table[k] for k in reversed(sortby)])
+    first = table[sortby[0]][order]
+    _, starts, counts = numpy.unique(first, return_index=True,
+                                     return_counts=True)
+    # reverse every second group of equal first key
+    position = numpy.arange(len(order))
+    group = numpy.repeat(numpy.arange(len(starts)), counts)
+    reverse = group % 2 == 1
+    start, end = starts[group], starts[group] + counts[group] - 1
+    position[reverse] = (start + end - position)[reverse]
+    return order[position]
+
+
+def plan_chunks(shape, dtype, depth=0, workers=None, target_bytes=2**22):
+    """Plan chunks for :func:`apply_chunks`. Chunks are about
+    ``target_bytes`` large, but small enough for every worker to get a
+    chunk, and at least ``8*depth`` wide to keep the overlap small.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of array.
+    dtype : numpy.dtype
+        Type of array.
+    depth : int
+        Overlap between chunks.
+    workers : int, optional
+        Number of workers, defaults to number of cpus.
+    target_bytes : int
+        Wanted size of each chunk, default 4 MiB which fits in most L2/L3
+        caches.
+
+    Returns
+    -------
+    chunks, halo_ratio
+        Chunk sizes along each dimension and the expected overhead of
+        overlap between chunks, as extra elements computed relative to
+        array size.
+
+    Example
+    -------
+    >>> chunks, halo_ratio = plan_chunks((1000, 1000), 'uint8', depth=4,
+    ...                                  workers=4)
+    >>> chunks
+    ((500, 500), (500, 500))
+    >>> round(halo_ratio, 3)
+    0.016
     """
+    workers = workers or cpu_count()
+    itemsize = numpy.dtype(dtype).itemsize
+    size = int(numpy.prod(shape))
+    if size == 0:
+        return tuple((n,) for n in shape), 0.
+
+    # elements per chunk, at least one chunk per worker
+    elements = min(max(target_bytes // itemsize, 1), ceil(size / workers))
+    wanted = int(ceil(size / elements))
+    # most chunks along each axis, keeping them at least 8*depth wide
+    limits = [max(n // (8*depth), 1) if depth else n for n in shape]
+
+    # split widest chunks until there are enough of them, axes which can
+    # not be split further leave the budget to the other axes
+    counts = [1] * len(shape)
+    while numpy.prod(counts) < wanted:
+        splittable = [i for i in range(len(shape)) if counts[i] < limits[i]]
+        if not splittable:
+            break
+        i = max(splittable, key=lambda i: shape[i] / counts[i])
+        counts[i] += 1
+
     chunks = []
-    nchunks_per_dim = int(ceil(ncpu ** (1./len(shape))))
+    for n, count in zip(shape, counts):
+        regular, remainder = divmod(n, count)
+        chunks.append((regular+1,)*remainder + (regular,)*(count-remainder))
+    chunks = tuple(chunks)
+
+    # overlap is only added between chunks, not at the array border
+    extended = 1
+    for c in chunks:
+        extended *= sum(c) + 2*depth*(len(c) - 1)
+    return chunks, extended / size - 1
+
+
+_pools = {}
+_pools_lock = Lock()
+# number of workers of pools from get_pool
+_pool_workers = weakref.WeakKeyDictionary()
 
-    used_chunks = 1
-    for i in shape:
-        if used_chunks < ncpu:
-            regular_chunk = i // nchunks_per_dim
-            remainder_chunk = regular_chunk + (i % nchunks_per_dim)
+def get_pool(scheduler='threads', num_workers=None):
+    """Worker pool for ``scheduler``, created on first use and reused by later
+    calls. Avoids pool startup on every filter update.
 
-            if regular_chunk == 0:
-                chunk_lens = (remainder_chunk,)
+    Parameters
+    ----------
+    scheduler : 'threads' or 'processes'
+        Kind of pool.
+    num_workers : int, optional
+        Number of workers, defaults to number of cpus.
+
+    Returns
+    -------
+    concurrent.futures.Executor
+    """
+    num_workers = num_workers or cpu_count()
+    key = (scheduler, num_workers)
+    # created once, also when called from several threads at the same time
+    with _pools_lock:
+        if key not in _pools:
+            if scheduler == 'threads':
+                pool = ThreadPoolExecutor(num_workers)
+            elif scheduler == 'processes':
+                pool = ProcessPoolExecutor(num_workers)
             else:
-                chunk_lens = ((regular_chunk,) * (nchunks_per_dim - 1) +
-                              (remainder_chunk,))
-        else:
-            chunk_lens = (i,)
+                raise ValueError(
+                    "scheduler should be 'threads' or 'processes'")
+            _pools[key] = pool
+            _pool_workers[pool] = num_workers
+        return _pools[key]
+
+
+def _num_workers(pool):
+    "Number of workers of a pool from get_pool, else None."
+    if pool is None:
+        return None
+    return _pool_workers.get(pool)
 
-        chunks.append(chunk_lens)
-        used_chunks *= nchunks_per_dim
-    return tuple(chunks)
+
+@atexit.register
+def shutdown_pools():
+    "Shut down worker pools created by get_pool."
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown(wait=False)
+        _pools.clear()
 
 
 def apply_chunks(function, array, chunks=None, depth=0, mode=None,
-                 extra_arguments=(), extra_keywords={}):
+                 extra_arguments=(), extra_keywords={}, scheduler='threads',
+                 pool=None):
     """Map a function in parallel across an array.
     Split an array into possibly overlapping chunks of a given depth and
     boundary type, call the given function in parallel on the chunks, combine
@@ -146,16 +266,17 @@ def apply_chunks(function, array, chunks=None, depth=0, mode=None,
     ----------
     function : function
         Function to be mapped which takes an array as an argument.
-    array : numpy array
-        Array which the function will be applied to.
+    array : numpy array or dask array
+        Array which the function will be applied to. A dask array is
+        rechunked, not loaded into memory at once.
     chunks : int, tuple, or tuple of tuples, optional
         A single integer is interpreted as the length of one side of a square
         chunk that should be tiled across the array.  One tuple of length
         ``array.ndim`` represents the shape of a chunk, and it is tiled across
         the array.  A list of tuples of length ``ndim``, where each sub-tuple
         is a sequence of chunk sizes along the corresponding dimension. If
-        None, the array is broken up into chunks based on the number of
-        available cpus. More information about chunks is in the documentation
+        None, chunks are planned with :func:`plan_chunks`. More information
+        about chunks is in the documentation
         `here <https://dask.pydata.org/en/latest/array-design.html>`_.
     depth : int, optional
         Integer equal to the depth of the added boundary cells. Defaults to
@@ -166,11 +287,21 @@ def apply_chunks(function, array, chunks=None, depth=0, mode=None,
         Tuple of arguments to be passed to the function.
     extra_keywords : dictionary, optional
         Dictionary of keyword arguments to be passed to the function.
+    scheduler : 'threads', 'processes' or 'synchronous', optional
+        How chunks are computed. Threads share memory with the array and
+        run in parallel for functions which release the GIL (numba
+        ``nogil=True``). Processes pickle chunks to the workers.
+        Synchronous computes chunks one by one in the calling thread, useful
+        for debugging and when called from other workers.
+    pool : concurrent.futures.Executor, optional
+        Pool to compute chunks with. Defaults to a pool from
+        :func:`get_pool`, which persists between calls. Chunks are planned
+        for the workers of pools from :func:`get_pool`, else for the number
+        of cpus.
     """
     if chunks is None:
-        shape = array.shape
-        ncpu = cpu_count()
-        chunks = _get_chunks(shape, ncpu)
+        workers = _num_workers(pool)
+        chunks, _ = plan_chunks(array.shape, array.dtype, depth, workers)
 
     if mode == 'wrap':
         mode = 'periodic'
@@ -178,16 +309,391 @@ def apply_chunks(function, array, chunks=None, depth=0, mode=None,
     def wrapped_func(arr):
         return function(arr, *extra_arguments, **extra_keywords)
 
-    darr = da.from_array(array, chunks=chunks)
-    return darr.map_overlap(wrapped_func, depth, boundary=mode).compute()
+    if isinstance(array, da.Array):
+        # lazily loaded, like a chunked array on disk
+        darr = array.rechunk(chunks)
+    else:
+        darr = da.from_array(array, chunks=chunks)
+    result = darr.map_overlap(wrapped_func, depth, boundary=mode)
+    if scheduler == 'synchronous':
+        return result.compute(scheduler=scheduler)
+    if pool is None:
+        pool = get_pool(scheduler)
+    return result.compute(scheduler=scheduler, pool=pool)
+
+
+def _freeze(value):
+    "Hashable representation of stage parameters."
+    if isinstance(value, dict):
+        return tuple((k, _freeze(v)) for k, v in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, numpy.ndarray):
+        if value.nbytes <= 4096: # selem and alike, compare by content
+            return (value.shape, value.dtype.str, value.tobytes())
+        return ('id', id(value))
+    return value
+
+
+class StageCache(object):
+    """Least recently used cache of filter stage results. Results are keyed
+    on identity of the input image and the stage parameters, so a stage
+    is only recomputed when its input or parameters changes. Inputs are
+    not kept alive by the cache, results of an input are evicted when
+    the input is garbage collected.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum total size of cached results. Least recently used results
+        are evicted when exceeded.
+
+    Example
+    -------
+    >>> cache = StageCache(max_bytes=2**30)
+    >>> filtered = cache.cached(mean_filter, image, selem_size=9)
+    >>> filtered is cache.cached(mean_filter, image, selem_size=9)
+    True
+    """
+    def __init__(self, max_bytes=2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, image, parameters):
+        """Cached result of ``image`` filtered with ``parameters``, None if
+        not in cache.
+        """
+        key = (id(image), _freeze(parameters))
+        entry = self._entries.get(key)
+        # id may be reused by a new image when old one is collected
+        if entry is None or entry[0]() is not image:
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, image, parameters, result):
+        "Store result, evicting least recently used results if full."
+        nbytes = getattr(result, 'nbytes', 0)
+        if nbytes > self.max_bytes:
+            return
+        key = (id(image), _freeze(parameters))
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[2]
+        reference = weakref.ref(image, lambda ref: self._expire(key, ref))
+        self._entries[key] = (reference, result, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= evicted
+
+    def _expire(self, key, reference):
+        "Evict result of an input which was garbage collected."
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is reference:
+            del self._entries[key]
+            self.nbytes -= entry[2]
+
+    def cached(self, function, image, **parameters):
+        "Call ``function(image, **parameters)`` unless result is cached."
+        key = (function, parameters)
+        result = self.get(image, key)
+        if result is None:
+            result = function(image, **parameters)
+            self.put(image, key, result)
+        return result
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+
+def _tiles(shape, chunks, depth):
+    """Slices of tiles given by chunks. Yields (outer, inner, trim) where
+    ``outer`` is the tile with overlap (clipped at array border), ``inner``
+    the tile without overlap and ``trim`` is ``inner`` relative to ``outer``.
+    """
+    per_dim = []
+    for n, sizes in zip(shape, chunks):
+        dim = []
+        start = 0
+        for size in sizes:
+            stop = start + size
+            first, last = max(start - depth, 0), min(stop + depth, n)
+            dim.append((slice(first, last), slice(start, stop),
+                        slice(start - first, stop - first)))
+            start = stop
+        per_dim.append(dim)
+    for tile in product(*per_dim):
+        yield tuple(zip(*tile))
+
+
+def map_tiles(function, array, out, chunks=None, depth=0, partial=None,
+              extra_arguments=(), extra_keywords={}, scheduler='threads',
+              pool=None):
+    """Apply function on overlapping tiles of array, writing results into
+    ``out``. Unlike :func:`apply_chunks`, tiles are read and written one by
+    one, so ``array`` and ``out`` may be memory mapped or lazily loaded
+    (anything which supports slicing). Overlap is not padded at the array
+    border, ``function`` should handle borders itself.
+
+    Parameters
+    ----------
+    function : function
+        Function which takes an array tile and returns a filtered tile of
+        same shape.
+    array : array like
+        Array which the function will be applied to.
+    out : array like
+        Array of same shape as ``array`` to write results into.
+    chunks : tuple of tuples, optional
+        Chunk sizes along each dimension, planned with :func:`plan_chunks`
+        if None.
+    depth : int
+        Overlap between tiles.
+    partial : function, optional
+        Function computing a partial result, like a histogram, from each
+        filtered tile. Used for global reductions without reading ``out``
+        again.
+    extra_arguments : tuple, optional
+        Tuple of arguments to be passed to the function.
+    extra_keywords : dictionary, optional
+        Dictionary of keyword arguments to be passed to the function.
+    scheduler : 'threads' or 'synchronous'
+        Tiles are written to ``out`` in place, so processes are not
+        supported.
+    pool : concurrent.futures.Executor, optional
+        Thread pool, defaults to :func:`get_pool`.
+
+    Returns
+    -------
+    list
+        Partial results for each tile, empty if ``partial`` is None.
+    """
+    if scheduler not in ('threads', 'synchronous'):
+        raise ValueError("scheduler should be 'threads' or 'synchronous'")
+    chunks = _tile_chunks(array, chunks, depth, pool)
+
+    def task(tile):
+        outer, inner, trim = tile
+        result = function(numpy.asarray(array[outer]), *extra_arguments,
+                          **extra_keywords)[trim]
+        out[inner] = result
+        if partial is not None:
+            return partial(result)
+
+    results = _map(task, _tiles(array.shape, chunks, depth), scheduler, pool)
+    if partial is None:
+        return []
+    return results
+
+
+def _tile_chunks(array, chunks, depth, pool):
+    """Chunks as tuple of tuples. Defaults to chunk layout of array (dask,
+    zarr, h5py), else planned with :func:`plan_chunks`.
+    """
+    if chunks is None:
+        chunks = getattr(array, 'chunks', None)
+    if chunks is None:
+        workers = _num_workers(pool)
+        chunks, _ = plan_chunks(array.shape, array.dtype, depth, workers)
+    return da.core.normalize_chunks(chunks, array.shape)
+
+
+def _map(task, items, scheduler, pool):
+    "Map task over items in pool, or in calling thread if synchronous."
+    if scheduler == 'synchronous':
+        return [task(i) for i in items]
+    if pool is None:
+        pool = get_pool(scheduler)
+    return list(pool.map(task, items))
 
 
-def stitch(experiment):
-    """Stitch experiment.
+def chunk_histogram(array, chunks=None, scheduler='threads', pool=None):
+    """Histogram of uint8 or uint16 array, accumulated chunk by chunk. Only
+    one chunk per worker is in memory, so ``array`` may be memory mapped or
+    a dask array larger than memory.
+
+    Parameters
+    ----------
+    array : array like
+        Image of type uint8 or uint16.
+    chunks : tuple of tuples, optional
+        Chunk sizes along each dimension. Defaults to the chunk layout of
+        ``array`` if it has one, else planned with :func:`plan_chunks`.
+    scheduler : 'threads' or 'synchronous'
+        How chunks are computed.
+    pool : concurrent.futures.Executor, optional
+        Thread pool, defaults to :func:`get_pool`.
+
+    Returns
+    -------
+    1d array
+        ``hist[v]`` is number of pixels with value ``v``.
+    """
+    dtype = numpy.dtype(array.dtype)
+    if dtype.kind != 'u' or dtype.itemsize > 2:
+        raise ValueError("Image should be uint8 or uint16")
+    if scheduler not in ('threads', 'synchronous'):
+        raise ValueError("scheduler should be 'threads' or 'synchronous'")
+    bins = numpy.iinfo(dtype).max + 1
+    chunks = _tile_chunks(array, chunks, 0, pool)
+
+    def task(tile):
+        outer = tile[0]
+        return numpy.bincount(numpy.asarray(array[outer]).ravel(),
+                              minlength=bins)
+
+    hist = numpy.zeros(bins, dtype=numpy.int64)
+    for h in _map(task, _tiles(array.shape, chunks, 0), scheduler, pool):
+        hist += h
+    return hist
+
+
+# TIFF tag ids
+_WIDTH, _LENGTH, _BITS, _SAMPLES, _FORMAT = 256, 257, 258, 277, 339
+# TIFF field type -> struct format: BYTE, SHORT, LONG, LONG8
+_TIFF_TYPES = {1: 'B', 3: 'H', 4: 'I', 16: 'Q'}
+# PNG color type -> samples per pixel, palette (3) is decoded to RGB
+_PNG_SAMPLES = {0: 1, 2: 3, 4: 2, 6: 4}
+_experiment_info = {}
+
+
+def _tiff_info(f):
+    "Shape and dtype from first IFD of TIFF or BigTIFF file object."
+    order = {b'II': '<', b'MM': '>'}[f.read(2)]
+    version, = struct.unpack(order + 'H', f.read(2))
+    if version == 42:
+        head, entry, value_size = 'I', 'HHI4s', 4
+        ifd, = struct.unpack(order + 'I', f.read(4))
+        count_format = 'H'
+    elif version == 43:
+        head, entry, value_size = 'Q', 'HHQ8s', 8
+        f.read(4) # bytesize and padding
+        ifd, = struct.unpack(order + 'Q', f.read(8))
+        count_format = 'Q'
+    else:
+        raise ValueError('Not a TIFF file')
+
+    f.seek(ifd)
+    count_size = struct.calcsize(count_format)
+    n, = struct.unpack(order + count_format, f.read(count_size))
+    entry_size = struct.calcsize(order + entry)
+    data = f.read(n * entry_size)
+    tags = {}
+    for i in range(n):
+        tag, type_, count, value = struct.unpack_from(order + entry, data,
+                                                      i * entry_size)
+        if tag not in (_WIDTH, _LENGTH, _BITS, _SAMPLES, _FORMAT) or \
+           type_ not in _TIFF_TYPES:
+            continue
+        fmt = order + _TIFF_TYPES[type_]
+        if count * struct.calcsize(fmt) > value_size:
+            # value stored elsewhere, only first is needed
+            offset, = struct.unpack(order + head, value)
+            position = f.tell()
+            f.seek(offset)
+            value = f.read(struct.calcsize(fmt))
+            f.seek(position)
+        tags[tag], = struct.unpack_from(fmt, value)
+
+    bits = tags.get(_BITS, 1)
+    if bits == 1:
+        dtype = numpy.dtype(bool)
+    else:
+        kind = {1: 'u', 2: 'i', 3: 'f'}[tags.get(_FORMAT, 1)]
+        dtype = numpy.dtype('%s%d' % (kind, bits // 8))
+    shape = (tags[_LENGTH], tags[_WIDTH])
+    samples = tags.get(_SAMPLES, 1)
+    if samples > 1:
+        shape += (samples,)
+    return shape, dtype
+
+
+def _png_info(f):
+    "Shape and dtype from IHDR chunk of PNG file object, None if palette."
+    f.read(8) # signature
+    length, chunk = struct.unpack('>I4s', f.read(8))
+    if chunk != b'IHDR':
+        raise ValueError('Not a PNG file')
+    width, height, bits, color = struct.unpack('>IIBB', f.read(10))
+    if color not in _PNG_SAMPLES or bits < 8:
+        return None
+    shape = (height, width)
+    samples = _PNG_SAMPLES[color]
+    if samples > 1:
+        shape += (samples,)
+    return shape, numpy.dtype('u%d' % (bits // 8))
+
+
+def image_info(path):
+    """Shape and dtype of image, without decoding pixels. TIFF and PNG
+    headers are read directly, other formats are decoded.
+
+    Parameters
+    ----------
+    path : str
+        Image file.
+
+    Returns
+    -------
+    tuple (shape, dtype)
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(8)
+        f.seek(0)
+        info = None
+        if magic[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):
+            info = _tiff_info(f)
+        elif magic == b'\x89PNG\r\n\x1a\n':
+            info = _png_info(f)
+    if info is None:
+        from skimage.io import imread
+        img = imread(path)
+        info = img.shape, img.dtype
+    return info
+
+
+def experiment_image_info(experiment):
+    """Shape and dtype of images in experiment, see :func:`image_info`.
+    Read once per experiment path, as all fields are equal in size.
+
+    Parameters
+    ----------
+    experiment : leicaexperiment.Experiment
+
+    Returns
+    -------
+    tuple (shape, dtype)
+    """
+    key = os.path.abspath(experiment.path)
+    if key not in _experiment_info:
+        _experiment_info[key] = image_info(experiment.images[0])
+    return _experiment_info[key]
+
+
+REGISTRATION_CACHE = 'leicaautomator-registration.json'
+_cache_lock = Lock()
+
+def stitch(experiment, out=None, cache=True, well=(0, 0)):
+    """Stitch one well of experiment.
 
     Parameters
     ----------
     experiment : leicaexperiment.Experiment
+    out : str, optional
+        Filename of ``.npy`` file to write stitched image into. The image is
+        then merged stripe by stripe and returned as a read only memory map,
+        so it may be larger than memory.
+    cache : bool or str
+        Registered offsets between images are cached in a json file in the
+        experiment folder, or the filename given. Restitching skips
+        registration of unchanged images. False disables the cache.
+    well : tuple (u, v)
+        Well to stitch, default is top left well.
 
     Returns
     -------
@@ -197,17 +703,225 @@ def stitch(experiment):
     if type(experiment) == str:
         experiment = Experiment(experiment)
 
-    images = []
+    images = _well_images(experiment).get(tuple(well))
+    if not images:
+        raise ValueError('experiment have no images in well %s' % (well,))
+
+    if cache is True:
+        cache = os.path.join(experiment.path, REGISTRATION_CACHE)
+    offset = register(images, cache or None)
+
+    return merge(images, offset, out), offset
+
+
+def _well_images(experiment):
+    "Images of experiment as {(u, v): [(path, row, column), ...]}."
+    wells = {}
     for i in experiment.images:
         attr = attributes(i)
-        if attr.u != 0 or attr.v != 0:
-            warn('experiment have several wells, assuming top left well')
-            continue
-        images.append((i, attr.y, attr.x))
+        wells.setdefault((attr.u, attr.v), []).append((i, attr.y, attr.x))
+    return wells
+
+
+def stitch_wells(experiment, out=None, cache=True):
+    """Stitch all wells of experiment, one well per worker.
+
+    Parameters
+    ----------
+    experiment : leicaexperiment.Experiment
+    out : str, optional
+        Filename pattern of ``.npy`` files to write stitched wells into,
+        formatted with ``u`` and ``v``. Example:
+        ``'overview--U{u:02d}--V{v:02d}.npy'``.
+    cache : bool or str
+        Cache of registered offsets, see :func:`stitch`.
+
+    Returns
+    -------
+    dict
+        ``{(u, v): (stitched, offset)}`` for every well, empty if the
+        experiment has no images.
+    """
+    if type(experiment) == str:
+        experiment = Experiment(experiment)
+
+    wells = sorted(_well_images(experiment))
+    if not wells:
+        return {}
+    def task(well):
+        u, v = well
+        well_out = out.format(u=u, v=v) if out else None
+        return stitch(experiment, well_out, cache, well)
 
+    with ThreadPoolExecutor(min(len(wells), cpu_count())) as pool:
+        return dict(zip(wells, pool.map(task, wells)))
+
+
+def _file_key(path):
+    "Identify file by absolute path, modification time and size."
+    stat = os.stat(path)
+    return '%s:%d:%d' % (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def _translation(pair):
+    "Translation (y, x) of second image relative to first image."
+    import imreg_dft
+    from skimage.io import imread
+    first, second = pair
     with catch_warnings():
         filterwarnings("ignore")
-        stitched = mstitch(images)
+        result = imreg_dft.translation(imread(first), imread(second))
+    # imreg_dft >= 2 returns a dict
+    tvec = result['tvec'] if isinstance(result, dict) else result[0]
+    return [float(t) for t in tvec]
+
+
+def _read_cache(cache):
+    "Registration cache, empty if missing or unreadable."
+    try:
+        with open(cache) as f:
+            stored = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return stored if isinstance(stored, dict) else {}
+
+
+def _write_cache(cache, stored):
+    "Write registration cache atomically, readers never see a partial file."
+    directory = os.path.dirname(os.path.abspath(cache))
+    fd, tmp = tempfile.mkstemp(suffix='.json', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(stored, f)
+        os.replace(tmp, cache)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def register(images, cache=None, scheduler='processes'):
+    """Register offset between regular spaced images. Each pair of
+    neighbouring images is registered in parallel, the offset is the median
+    of all pairs.
+
+    Parameters
+    ----------
+    images : list of tuple(path, row, column)
+        Row 0, column 0 is top left image.
+    cache : str, optional
+        Filename of json file with translations of registered pairs. Pairs
+        are keyed by path, modification time and size of both images, so
+        only new or changed images are registered.
+    scheduler : 'processes', 'threads' or 'synchronous'
+        How pairs are registered.
+
+    Returns
+    -------
+    tuple (y, x)
+        Registered offset between rows and columns, negative for overlap.
+    """
+    paths = dict(((r, c), p) for p, r, c in images)
+    # (image above, image) and (image to the left, image)
+    pairs = {'y': [], 'x': []}
+    for (r, c), path in sorted(paths.items()):
+        if (r-1, c) in paths:
+            pairs['y'].append((paths[r-1, c], path))
+        if (r, c-1) in paths:
+            pairs['x'].append((paths[r, c-1], path))
+
+    cached = {}
+    if cache:
+        with _cache_lock:
+            cached = _read_cache(cache)
+
+    keys = dict((pair, '|'.join(_file_key(p) for p in pair))
+                for pair in pairs['y'] + pairs['x'])
+    missing = [pair for pair, key in keys.items() if key not in cached]
+    if missing:
+        registered = {}
+        for pair, translation in zip(missing, _map(_translation, missing,
+                                                   scheduler, None)):
+            registered[keys[pair]] = translation
+        cached.update(registered)
+        if cache:
+            # wells may be registered concurrently, merge with file content
+            with _cache_lock:
+                stored = _read_cache(cache)
+                stored.update(registered)
+                _write_cache(cache, stored)
+
+    offset = []
+    for axis, direction in enumerate('yx'):
+        translations = [cached[keys[pair]][axis] for pair in pairs[direction]]
+        if not translations:
+            offset.append(0)
+            continue
+        median = numpy.median(translations)
+        if median >= 0:
+            raise ValueError('%s offset should be negative, got %s'
+                             % (direction, median))
+        offset.append(median)
+    return tuple(offset)
+
 
-    return stitched
+def merge(images, offset, out=None):
+    """Merge regular spaced images, overlap is averaged. The stitched image
+    is written one stripe of image rows at a time, only the images
+    overlapping the current stripe are kept in memory.
 
+    Parameters
+    ----------
+    images : list of tuple(path, row, column)
+        Row 0, column 0 is top left image. All images should have the same
+        shape.
+    offset : tuple (y, x)
+        Registered offset between images in pixels, negative for overlap.
+    out : str, optional
+        Filename of ``.npy`` file to write stitched image into.
+
+    Returns
+    -------
+    ndarray
+        Stitched image, memory mapped read only if ``out`` is given.
+    """
+    from skimage.io import imread
+    yoffset, xoffset = (int(round(o)) for o in offset)
+    first = imread(images[0][0])
+    height, width = first.shape[:2]
+    ystep, xstep = height + yoffset, width + xoffset
+    paths = dict(((r, c), p) for p, r, c in images)
+    rows = max(r for _, r, _ in images) + 1
+    cols = max(c for _, _, c in images) + 1
+    shape = (height + ystep*(rows-1), width + xstep*(cols-1))
+
+    if out is None:
+        stitched = numpy.zeros(shape, dtype=first.dtype)
+    else:
+        stitched = numpy.lib.format.open_memmap(out, mode='w+',
+                                                dtype=first.dtype, shape=shape)
+
+    # each image is read once or twice, as it overlaps at most two stripes
+    rows_per_stripe = int(ceil(height / ystep)) + 1
+    read = lru_cache(maxsize=cols*rows_per_stripe)(imread)
+
+    for stripe in range(rows):
+        start = stripe * ystep
+        stop = shape[0] if stripe == rows-1 else start + ystep
+        total = numpy.zeros((stop-start, shape[1]), dtype=numpy.uint32)
+        count = numpy.zeros((stop-start, shape[1]), dtype=numpy.uint8)
+        for (r, c), path in paths.items():
+            top = r * ystep
+            first_row, last_row = max(top, start), min(top + height, stop)
+            if first_row >= last_row:
+                continue
+            left = c * xstep
+            img = read(path)[first_row-top:last_row-top]
+            total[first_row-start:last_row-start, left:left+width] += img
+            count[first_row-start:last_row-start, left:left+width] += 1
+        stitched[start:stop] = total // numpy.maximum(count, 1)
+
+    if out is None:
+        return stitched
+    stitched.flush()
+    del stitched
+    return numpy.load(out, mmap_mode='r')
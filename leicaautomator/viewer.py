@@ -1,13 +1,14 @@
 """
 scikit-image viewer plugins and widgets.
 """
-from skimage import viewer, draw, filters, exposure, measure, color, morphology
-from skimage.measure._regionprops import _RegionProperties
+from skimage import viewer, filters, exposure, measure, color, morphology
 
-#from .filters import pop_bilateral, mean
-from .filters import mean
-from skimage.filters.rank import pop_bilateral
-from .utils import apply_chunks
+from .pipeline import (bilateral_filter, mean_filter, otsu_threshold,
+                       li_threshold, RegionPipeline,
+                       extract_regions, set_well_positions, WellGrid,
+                       preview_factor, scale_selem)
+from .regions import RegionTable, RegionIndex
+from .utils import StageCache
 
 import scipy.ndimage as nd
 import numpy as np
@@ -17,7 +18,27 @@ from matplotlib.patches import Polygon
 # Viewer
 ##
 class ImageViewer(viewer.viewers.ImageViewer):
-    "override viewer to not emit plugin._update_original_image"
+    """override viewer to not emit plugin._update_original_image
+
+    Parameters
+    ----------
+    image : 2d array
+        Image to filter.
+    preview : bool
+        Run plugins on a downsampled pyramid level of ``image`` which fits
+        ``max_size``, for fast feedback. :meth:`commit` runs plugins on the
+        full resolution image.
+    max_size : int
+        Maximum side length of preview image.
+    """
+    def __init__(self, image, preview=False, max_size=2048, **kwargs):
+        self.full_image = image
+        self.preview_factor = 1
+        if preview:
+            self.preview_factor = preview_factor(image.shape, max_size)
+            # strided, as averaging would smooth out texture
+            image = image[::self.preview_factor, ::self.preview_factor]
+        super(ImageViewer, self).__init__(image, **kwargs)
 
     #copied from scikit-image
     def __add__(self, plugin):
@@ -49,6 +70,38 @@ class ImageViewer(viewer.viewers.ImageViewer):
                 break
         return super(ImageViewer, self).show()
 
+    def commit(self):
+        "Leave preview mode and run plugins on full resolution image."
+        if self.preview_factor == 1:
+            return
+        self.preview_factor = 1
+        self.original_image = self.full_image
+        self.plugins[0]._update_original_image(self.full_image)
+
+    def region_pipeline(self):
+        """RegionPipeline with the settings of the plugins, to filter the
+        full resolution image without the GUI, like after the GUI is closed
+        in preview mode.
+        """
+        plugins = dict((type(p), p) for p in self.plugins)
+        bilateral = plugins.get(PopBilateralPlugin)
+        mean = plugins.get(MeanPlugin)
+        otsu = plugins.get(OtsuPlugin)
+        region = plugins.get(RegionPlugin)
+        parameters = {}
+        if bilateral is not None:
+            parameters.update(
+                bilateral_selem=bilateral.size.val if bilateral.enabled
+                                else None,
+                s0=bilateral.s0.val, s1=bilateral.s1.val)
+        if mean is not None:
+            parameters['mean_selem'] = mean.size.val if mean.enabled else None
+        if otsu is not None:
+            parameters['threshold'] = otsu.enabled
+        if region is not None:
+            parameters['max_regions'] = region.max_regions.val
+        return RegionPipeline(**parameters)
+
 
 
 ##
@@ -83,19 +136,31 @@ class SeriesPlugin(viewer.plugins.Plugin):
             factor = img.shape[0] // 2048
         else:
             factor = 1
-        self.view_factor = factor
-        self.image_viewer.view_factor = factor
+        # regions are in full resolution pixels
+        view_factor = factor * self.image_viewer.preview_factor
+        self.view_factor = view_factor
+        self.image_viewer.view_factor = view_factor
         self.image_viewer.image = img[::factor, ::factor]
 
 
 class EnablePlugin(SeriesPlugin):
-    "Plugin with checkbox for enable/disable"
+    """Plugin with checkbox for enable/disable. Results are cached on input
+    image and widget values, set ``cache_bytes = 0`` to disable caching.
+    """
+    cache_bytes = 2**29
     def __init__(self, **kwargs):
         super(EnablePlugin, self).__init__(**kwargs)
+        self._widgets = []
+        self.cache = StageCache(self.cache_bytes) if self.cache_bytes else None
         enable = viewer.widgets.CheckBox('enabled', value=False, ptype='plugin')
         self.add_widget(enable)
         self.enabled = False
 
+    def add_widget(self, widget):
+        "Keep track of widgets, their values are used as cache key."
+        super(EnablePlugin, self).add_widget(widget)
+        self._widgets.append(widget)
+
     def update_plugin(self, name, val):
         super(EnablePlugin, self).update_plugin(name,val)
         self.filter_image()
@@ -106,7 +171,7 @@ class EnablePlugin(SeriesPlugin):
             arguments = [self._get_value(a) for a in self.arguments]
             kwargs = dict([(name, self._get_value(a))
                            for name, a in self.keyword_arguments.items()])
-            filtered = self.image_filter(*arguments, **kwargs)
+            filtered = self.cached_filter(arguments, kwargs)
         elif len(self.arguments):
             # not enabled
             filtered = self.arguments[0]
@@ -118,6 +183,17 @@ class EnablePlugin(SeriesPlugin):
         # send to next plugin
         self.image_changed.emit(filtered)
 
+    def cached_filter(self, arguments, kwargs):
+        "image_filter through cache, key is input image and widget values."
+        if self.cache is None:
+            return self.image_filter(*arguments, **kwargs)
+        key = tuple((w.name, getattr(w, 'val', None)) for w in self._widgets)
+        filtered = self.cache.get(arguments[0], key)
+        if filtered is None:
+            filtered = self.image_filter(*arguments, **kwargs)
+            self.cache.put(arguments[0], key, filtered)
+        return filtered
+
 
 
 class SelemPlugin(EnablePlugin):
@@ -138,6 +214,15 @@ class SelemPlugin(EnablePlugin):
         self.keyword_arguments['selem'] = morphology.square(value)
         self.filter_image()
 
+    @property
+    def scaled_size(self):
+        "Selem size scaled to preview image."
+        return scale_selem(self.size.val, self.image_viewer.preview_factor)
+
+    def cached_filter(self, arguments, kwargs):
+        kwargs['selem'] = morphology.square(self.scaled_size)
+        return super(SelemPlugin, self).cached_filter(arguments, kwargs)
+
 
 class CropPlugin(SeriesPlugin):
     "Crop plugin with reset button"
@@ -185,13 +270,8 @@ class PopBilateralPlugin(SelemPlugin):
         self.add_widget(self.s0)
         self.add_widget(self.s1)
 
-    def image_filter(self, img, **kwargs):
-        filtered = apply_chunks(pop_bilateral, img, depth=self.size.val//2, extra_keywords=kwargs)
-        filtered = self.size.val**2 - filtered # invert
-        filtered -= filtered.min()
-        factor = 255 / filtered.max()
-        filtered *= factor
-        return filtered
+    def image_filter(self, img, s0, s1, **kwargs):
+        return bilateral_filter(img, self.scaled_size, s0, s1)
 
 
 class MeanPlugin(SelemPlugin):
@@ -199,15 +279,14 @@ class MeanPlugin(SelemPlugin):
     selem_size = 9
 
     def image_filter(self, img, **kwargs):
-        return apply_chunks(mean, img, depth=self.size.val//2, extra_keywords=kwargs)
+        return mean_filter(img, self.scaled_size)
 
 
 class OtsuPlugin(EnablePlugin):
     name = "Otsu Threshold"
 
     def image_filter(self, image, **kwargs):
-        t = filters.threshold_otsu(image)
-        return image >= t
+        return otsu_threshold(image)
 
 
 class LiThresholdPlugin(EnablePlugin):
@@ -219,11 +298,7 @@ class LiThresholdPlugin(EnablePlugin):
         self.invert = False
 
     def image_filter(self, image, **kwargs):
-        t = filters.threshold_li(image)
-        if self.invert:
-            return image < t
-        else:
-            return image >= t
+        return li_threshold(image, self.invert)
 
 
 class ErosionPlugin(SelemPlugin):
@@ -296,6 +371,7 @@ class LabelPlugin(EnablePlugin):
 
 class RegionPlugin(EnablePlugin):
     name = 'Region'
+    cache_bytes = 0 # image_filter sets regions and polygons
     def __init__(self, **kwargs):
         super(RegionPlugin, self).__init__(**kwargs)
         self.max_regions = viewer.widgets.Slider('maximum number of regions',
@@ -305,59 +381,45 @@ class RegionPlugin(EnablePlugin):
 
     def attach(self, image_viewer):
         super(RegionPlugin, self).attach(image_viewer)
-        self.regions = []
+        self.regions = RegionTable()
+        self.polygons = {} # label -> Polygon
+        self.texts = {} # label -> Text
 
-        self.move_region = MoveRegion(image_viewer, self)
-        image_viewer.add_tool(self.move_region)
+        self.move_tool = MoveRegion(image_viewer, self)
+        image_viewer.add_tool(self.move_tool)
+        if image_viewer.preview_factor > 1:
+            self.add_widget(CommitWidget())
 
 
     def filter_image(self, *args, **kwargs):
-        if self.regions:
-            # remove previous regions from canvas
-            for r in self.regions:
-                try:
-                    r._polygon.remove()
-                    r._text.remove()
-                except ValueError:
-                    continue
+        # remove previous regions from canvas
+        for artist in list(self.polygons.values()) + list(self.texts.values()):
+            try:
+                artist.remove()
+            except ValueError:
+                continue
+        self.polygons, self.texts = {}, {}
         super(RegionPlugin, self).filter_image(*args, **kwargs)
 
 
     def image_filter(self, img):
-        self.labels = measure.label(img, background=0)
-        # do not use label 0
-        self.labels[self.labels==0] = self.labels.max() + 1
-        # sorted by size, largest first
-        self.regions = sorted((r for r in measure.regionprops(self.labels)),
-                              key=lambda r: -r.area)
-        # only keep max_regions
-        if len(self.regions) > self.max_regions.val:
-            self.regions = self.regions[:self.max_regions.val]
-
-        self.median_area = np.median([r.area for r in self.regions])
-
-        self.set_coordinates()
-        self.set_well_positions()
+        self.regions = extract_regions(img, self.max_regions.val)
+        # coordinates in full resolution pixels
+        self.regions.scale(self.image_viewer.preview_factor)
+        self.median_area = np.median(self.regions['area'])
+
+        self.grid = WellGrid(self.regions)
+        self.index = RegionIndex(self.regions)
         self.create_polygons()
         # overlay on original image
         return self.image_viewer.original_image
 
 
-    def set_coordinates(self):
-        if not self.regions:
-            return
-
-        for r in self.regions:
-            r.y, r.x, r.y_end, r.x_end = r.bbox
-
-
     def create_polygons(self):
-        "Creates region._polygon which can be added to the mpl axes."
-        if not self.regions:
-            return
-
+        "Creates polygons of regions which can be added to the mpl axes."
         for region in self.regions:
-            region = create_polygon(region, self.view_factor)
+            self.polygons[region.label] = create_polygon(region,
+                                                         self.view_factor)
 
 
     def display_filtered_image(self, image):
@@ -368,55 +430,23 @@ class RegionPlugin(EnablePlugin):
         super(RegionPlugin, self).display_filtered_image(image)
 
         if self.enabled:
-            for r in self.regions:
-                ax.add_patch(r._polygon)
+            for polygon in self.polygons.values():
+                ax.add_patch(polygon)
             self.set_texts()
             self.image_viewer.canvas.draw()
 
 
     def set_well_positions(self):
-        """Set property well_x/y on region.
-
-        Returns
-        -------
-        list of skimage.regionprops
-            Regions with extra property ``well_x`` and ``well_y`` set (0-indexed).
+        """Set well_x/y of all regions, see
+        :func:`leicaautomator.pipeline.assign_wells`. Edits by
+        :class:`MoveRegion` update well positions incrementally.
         """
-        for direction in ['x', 'y']:
-            regions = sorted(self.regions, key=lambda r: getattr(r, direction))
-
-            # calc dx
-            previous = regions[0]
-            for region in regions:
-                dx = getattr(region, direction) - getattr(previous, direction)
-                setattr(region, 'd' + direction, dx)
-                previous = region
-
-            dxs = np.array([getattr(r, 'd' + direction) for r in regions])
-            min_threshold = dxs.max() * 0.5
-            mask = np.index_exp[dxs > min_threshold][0]
-            # do not include all high dxs
-            max_threshold = dxs.max() * 0.9
-            mask &= np.index_exp[dxs < max_threshold][0]
-            step = np.median(dxs[mask])
-
-            # add well_x/y property to region
-            well = 0
-            previous = regions[0]
-            for r in regions:
-                dx = getattr(r, direction) - getattr(previous, direction)
-                # if gradient to prev coordinate is high, we have a new row/column
-                if dx > min_threshold:
-                    well += 1
-                setattr(r, 'well_' + direction, well) # start at 1
-                previous = r
-
-        self.regions = regions
-        return regions
+        self.grid.update()
+        return self.regions
 
 
     def set_texts(self):
-        "create _text property of well positions"
+        "create texts of well positions"
         ax = self.image_viewer.ax
         factor = self.view_factor
         for r in self.regions:
@@ -424,25 +454,62 @@ class RegionPlugin(EnablePlugin):
             x = (r.x + (r.x_end - r.x) / 4) / factor
             y = (r.y_end - (r.y_end - r.y) / 3) / factor
             try:
-                r._text.set_text(text)
-                r._text.set_position((x, y))
-            except AttributeError:
-                r._text = ax.text(x, y, text, color='w',
-                                  fontsize=14, backgroundcolor='k')
+                self.texts[r.label].set_text(text)
+                self.texts[r.label].set_position((x, y))
+            except KeyError:
+                self.texts[r.label] = ax.text(x, y, text, color='w',
+                                              fontsize=14,
+                                              backgroundcolor='k')
+
+
+    def region_at(self, y, x):
+        "Region at pixel, first label if regions overlap. None if no region."
+        labels = self.index.at(y, x)
+        if not labels:
+            return None
+        return self.regions[self.regions.index(labels[0])]
+
+
+    def add_region(self, y, x, y_end, x_end, **kwargs):
+        "Add region and its polygon, returns label."
+        r = self.grid.add(y, x, y_end, x_end, **kwargs)
+        self.index.insert(r.label, r.bbox)
+        self.polygons[r.label] = create_polygon(r, self.view_factor)
+        return r.label
+
+
+    def move_region(self, label, dy, dx):
+        "Move region, its polygon is moved by caller."
+        self.grid.move(label, dy, dx)
+        self.index.move(label, self.regions[self.regions.index(label)].bbox)
+
+
+    def remove_region(self, label):
+        "Remove region and its artists."
+        self.grid.remove(label)
+        self.index.remove(label)
+        self.polygons.pop(label).remove()
+        self.texts.pop(label).remove()
 
 
     def output(self):
-        return self.regions
+        "Regions sorted by y, then x."
+        return set_well_positions(self.regions)
 
 ##
 # Helper functions
 ##
-def create_polygon(r, view_factor):
+def region_vertices(r, view_factor):
+    "Corners of region in view coordinates, as (x, y)."
     vertices = ((r.x, r.y), (r.x, r.y_end),
-                  (r.x_end, r.y_end), (r.x_end, r.y))
-    r.vertices = [(v[0]/view_factor, v[1]/view_factor) for v in vertices]
-    r._polygon = Polygon(r.vertices, fill=False, edgecolor='y', linewidth=2)
-    return r
+                (r.x_end, r.y_end), (r.x_end, r.y))
+    return [(v[0]/view_factor, v[1]/view_factor) for v in vertices]
+
+
+def create_polygon(r, view_factor):
+    "Polygon around region."
+    return Polygon(region_vertices(r, view_factor), fill=False,
+                   edgecolor='y', linewidth=2)
 
 
 ##
@@ -466,6 +533,25 @@ class ResetWidget(viewer.widgets.BaseWidget):
 
 
 
+class CommitWidget(viewer.widgets.BaseWidget):
+    "Commit button which leaves preview and filters full resolution image"
+    def __init__(self):
+        super(CommitWidget, self).__init__('commit', ptype='plugin')
+        self.commit_button = viewer.qt.QtGui.QPushButton('Commit')
+        self.commit_button.clicked.connect(self.commit)
+
+        self.layout = viewer.qt.QtGui.QHBoxLayout(self)
+        self.layout.addWidget(self.commit_button)
+
+    @property
+    def val(self):
+        return None
+
+    def commit(self):
+        self.plugin.image_viewer.commit()
+        self.commit_button.setEnabled(False)
+
+
 ##
 # Canvas tools
 ##
@@ -484,6 +570,11 @@ class MoveRegion(viewer.canvastools.base.CanvasToolBase):
     def on_mouse_press(self, event):
         if not event.xdata or not event.ydata:
             return
+        if self.viewer.preview_factor > 1:
+            # regions are extracted again on commit, edits would be lost
+            self.viewer.status_message('Press Commit before editing regions')
+            self.region = None
+            return
         x = int(event.xdata * self.viewer.view_factor)
         y = int(event.ydata * self.viewer.view_factor)
         # store position, for calculation dx/dy
@@ -491,18 +582,9 @@ class MoveRegion(viewer.canvastools.base.CanvasToolBase):
         self.y = y
 
         # will select first region if two regions overlap
-        self.region = next((r for r in self.region_plugin.regions
-                            if x >= r.x and x <= r.x_end and
-                            y >= r.y and y <= r.y_end), None)
+        self.region = self.region_plugin.region_at(y, x)
         if event.dblclick and self.region:
-            # remove (faster than list.remove)
-            self.region_plugin.regions = [r for r in self.region_plugin.regions
-                                          if r.label != self.region.label]
-            self.region._polygon.remove()
-            self.region._text.remove()
-
-            # recalculate well positions
-            self.region_plugin.set_well_positions()
+            self.region_plugin.remove_region(self.region.label)
             self.region_plugin.set_texts()
 
             self.canvas.draw()
@@ -510,37 +592,25 @@ class MoveRegion(viewer.canvastools.base.CanvasToolBase):
             return
 
         elif event.dblclick:
-            # add region where double click is at
-            label = self.region_plugin.labels.max() + 1
-            # square in label image
-            width = (self.region_plugin.median_area)**0.5 / 2
-            slice_ = (slice(y - width, y + width),
-                      slice(x - width, x + width))
-            self.region_plugin.labels[slice_] = label
-
-            # add region
-            r = _RegionProperties(slice_, label, self.region_plugin.labels,
-                                 intensity_image=None, cache_active=False)
-            r.y, r.x = r.centroid
-            r.x -= width
-            r.y -= width
-            # draw square around regions of interest
-            r.x_end = r.x + 2*width
-            r.y_end = r.y + 2*width
-
-            r = create_polygon(r, self.viewer.view_factor)
-            self.ax.add_patch(r._polygon)
-            self.region_plugin.regions.append(r)
-            self.region_plugin.set_well_positions()
+            # add square region where double click is at
+            width = int((self.region_plugin.median_area)**0.5 / 2)
+            label = self.region_plugin.add_region(y - width, x - width,
+                                                  y + width, x + width,
+                                                  centroid=(y, x))
+            polygon = self.region_plugin.polygons[label]
+            self.ax.add_patch(polygon)
             self.region_plugin.set_texts()
-            self.ax.draw_artist(r._polygon)
-            self.ax.draw_artist(r._text)
+            self.ax.draw_artist(polygon)
+            self.ax.draw_artist(self.region_plugin.texts[label])
             self.canvas.draw()
             self.region = None
             return
 
         elif self.region:
-            self.region._polygon.set_animated(True)
+            self.polygon = self.region_plugin.polygons[self.region.label]
+            self.vertices = region_vertices(self.region,
+                                            self.viewer.view_factor)
+            self.polygon.set_animated(True)
             self.background = self.canvas.copy_from_bbox(self.ax.bbox)
 
 
@@ -556,11 +626,11 @@ class MoveRegion(viewer.canvastools.base.CanvasToolBase):
         dy = y - self.y
         if dx == 0 and dy == 0:
             return
-        vertices = [(v[0]+dx/f, v[1]+dy/f) for v in self.region.vertices]
-        self.region._polygon.set_xy(vertices)
+        vertices = [(v[0]+dx/f, v[1]+dy/f) for v in self.vertices]
+        self.polygon.set_xy(vertices)
         # draw
         self.canvas.restore_region(self.background)
-        self.ax.draw_artist(self.region._polygon)
+        self.ax.draw_artist(self.polygon)
         self.canvas.blit(self.ax.bbox)
 
 
@@ -575,15 +645,10 @@ class MoveRegion(viewer.canvastools.base.CanvasToolBase):
         if dx == 0 and dy == 0:
             # on release first click in double click
             return
-        vertices = [(v[0]+dx/f, v[1]+dy/f) for v in self.region.vertices]
-        self.region._polygon.set_xy(vertices)
-        self.region.vertices = vertices
-        self.region.x += dx
-        self.region.x_end += dx
-        self.region.y += dy
-        self.region.y_end += dy
-        self.region._polygon.set_animated(False)
-        self.region_plugin.set_well_positions()
+        vertices = [(v[0]+dx/f, v[1]+dy/f) for v in self.vertices]
+        self.polygon.set_xy(vertices)
+        self.region_plugin.move_region(self.region.label, dy, dx)
+        self.polygon.set_animated(False)
         self.region_plugin.set_texts()
         self.canvas.draw()
         self.region = None
@@ -22,3 +22,831 @@ def test_stitch(experiment):
     assert offset[0] < 0, "offset between rows should be negative"
     assert offset[1] < 0, "offset between cols should be negative"
 
+
+def test_stitch_memory_mapped(experiment, tmpdir):
+    import numpy as np
+    stitched, offset = stitch(experiment)
+    mapped, mapped_offset = stitch(experiment,
+                                   out=tmpdir.join('stitched.npy').strpath)
+
+    assert isinstance(mapped, np.memmap)
+    assert mapped_offset == offset
+    assert (mapped == stitched).all()
+
+
+
+def test_stitch_wells(experiment, tmpdir):
+    from leicaautomator.utils import stitch_wells
+    stitched, offset = stitch(experiment)
+    wells = stitch_wells(experiment)
+
+    assert list(wells) == [(0, 0)]
+    assert wells[0, 0][1] == offset
+    assert (wells[0, 0][0] == stitched).all()
+
+    assert stitch_wells(tmpdir.mkdir('empty').strpath) == {}
+
+
+def test_registration_cache(experiment, tmpdir, monkeypatch):
+    import json
+    from leicaexperiment import attributes
+    from leicaautomator import utils
+    images = [(i, attributes(i).y, attributes(i).x)
+              for i in experiment.images[:6]]
+    cache = tmpdir.join('registration.json').strpath
+    offset = utils.register(images, cache, scheduler='synchronous')
+    with open(cache) as f:
+        stored = json.load(f)
+
+    def fail(pair):
+        raise AssertionError('registered %s, expected cached' % (pair,))
+    monkeypatch.setattr(utils, '_translation', fail)
+
+    assert utils.register(images, cache, scheduler='synchronous') == offset
+
+    # partially written cache is registered again and replaced
+    monkeypatch.undo()
+    with open(cache, 'w') as f:
+        f.write('{"truncated')
+    assert utils.register(images, cache, scheduler='synchronous') == offset
+    with open(cache) as f:
+        assert json.load(f) == stored
+
+
+@pytest.fixture
+def overview():
+    "Synthetic overview, 3 rows and 4 columns of textured cores on flat glass."
+    import numpy as np
+    rng = np.random.RandomState(0)
+    image = np.full((300, 400), 200, dtype=np.uint8)
+    yy, xx = np.mgrid[:300, :400]
+    for row in range(3):
+        for col in range(4):
+            y, x = 50 + row*100, 50 + col*100
+            disk = (yy - y)**2 + (xx - x)**2 < 30**2
+            image[disk] = rng.randint(0, 256, disk.sum())
+    return image
+
+
+def test_region_pipeline(overview):
+    regions = find_tma_regions(overview, interactive=False, max_regions=12)
+
+    assert len(regions) == 12
+    assert max(r.well_x for r in regions) == 3
+    assert max(r.well_y for r in regions) == 2
+    assert len(set((r.well_x, r.well_y) for r in regions)) == 12
+
+
+def test_stage_cache():
+    import numpy as np
+    from leicaautomator.utils import StageCache
+    calls = []
+    def stage(image, value):
+        calls.append(value)
+        return image + value
+
+    image = np.zeros((10, 10))
+    cache = StageCache(max_bytes=2*image.nbytes)
+    first = cache.cached(stage, image, value=1)
+    assert cache.cached(stage, image, value=1) is first
+    assert calls == [1]
+
+    # least recently used is evicted
+    cache.cached(stage, image, value=2)
+    cache.cached(stage, image, value=3)
+    cache.cached(stage, image, value=1)
+    assert calls == [1, 2, 3, 1]
+    assert len(cache) == 2
+
+    # input is not kept alive, its results are evicted
+    del image, first
+    assert len(cache) == 0
+    assert cache.nbytes == 0
+
+
+def test_region_pipeline_preview(overview):
+    from leicaautomator.pipeline import RegionPipeline
+    pipeline = RegionPipeline(max_regions=12)
+    preview = pipeline.preview(overview, max_size=200)
+    regions = pipeline(overview)
+
+    assert len(preview) == len(regions)
+    key = lambda r: (r.well_y, r.well_x)
+    for p, r in zip(sorted(preview, key=key), sorted(regions, key=key)):
+        assert abs(p.x - r.x) <= 4 and abs(p.y - r.y) <= 4
+
+
+def test_region_pipeline_preview_cache(overview):
+    from leicaautomator.pipeline import RegionPipeline
+    from leicaautomator.utils import StageCache
+    cache = StageCache()
+    pipeline = RegionPipeline(max_regions=12, cache=cache)
+    pipeline.preview(overview, max_size=200)
+    entries = len(cache)
+    pipeline.preview(overview, max_size=200)
+    # same strided view, stages are not run again
+    assert len(cache) == entries
+
+
+@pytest.mark.parametrize('dtype, shape, s0, s1', [
+    ('uint8', (30, 40), 10, 20), # bins are values
+    ('uint16', (15, 20), 3000, 1000), # few bins in range
+    ('uint16', (40, 50), 5000, 8000), # block totals
+])
+def test_pop_bilateral_ranges(dtype, shape, s0, s1):
+    import numpy as np
+    from leicaautomator.filters import pop_bilateral
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, np.iinfo(dtype).max, shape).astype(dtype)
+
+    out = pop_bilateral(img, np.ones((5, 5)), s0, s1)
+
+    padded = np.pad(img.astype(np.int64), 2, mode='edge')
+    windows = np.stack([padded[i:i+shape[0], j:j+shape[1]]
+                        for i in range(5) for j in range(5)])
+    f = img.astype(np.int64)
+    expected = ((windows >= f-s0) & (windows <= f+s1)).sum(axis=0)
+    assert (out == expected).all()
+
+
+def test_pop_bilateral_uint16():
+    import numpy as np
+    from leicaautomator.filters import pop_bilateral
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, 2**16, (15, 20)).astype(np.uint16)
+    s0, s1 = 3000, 1000
+
+    out = pop_bilateral(img, np.ones((5, 5)), s0, s1)
+
+    padded = np.pad(img.astype(np.int64), 2, mode='edge')
+    for y, x in [(0, 0), (7, 9), (14, 19)]:
+        window = padded[y:y+5, x:x+5]
+        f = int(img[y, x])
+        assert out[y, x] == ((window >= f-s0) & (window <= f+s1)).sum()
+
+
+@pytest.mark.parametrize('dtype', ['uint8', 'uint16'])
+def test_mean(dtype):
+    import numpy as np
+    from leicaautomator.filters import mean
+    rng = np.random.RandomState(0)
+    img = rng.randint(0, np.iinfo(dtype).max, (17, 23)).astype(dtype)
+
+    out = mean(img, np.ones((7, 7)))
+
+    padded = np.pad(img.astype(np.int64), 3, mode='edge')
+    sums = sum(padded[i:i+17, j:j+23] for i in range(7) for j in range(7))
+    assert out.dtype == img.dtype
+    assert (out == (sums + 49//2) // 49).all()
+
+
+@pytest.mark.parametrize('scheduler', ['threads', 'processes', 'synchronous'])
+def test_apply_chunks_scheduler(scheduler):
+    import numpy as np
+    from leicaautomator.filters import mean
+    from leicaautomator.utils import apply_chunks
+    img = np.random.RandomState(0).randint(0, 256, (64, 64)).astype(np.uint8)
+    selem = np.ones((5, 5))
+
+    out = apply_chunks(mean, img, chunks=(16, 16), depth=2, mode='nearest',
+                       extra_arguments=(selem,), scheduler=scheduler)
+
+    assert (out == mean(img, selem)).all()
+
+
+def test_get_pool():
+    from concurrent.futures import ThreadPoolExecutor
+    from leicaautomator.utils import get_pool, _num_workers
+    with ThreadPoolExecutor(8) as callers:
+        pools = list(callers.map(lambda _: get_pool('threads', 3), range(8)))
+    assert all(pool is pools[0] for pool in pools)
+    assert _num_workers(pools[0]) == 3
+    assert _num_workers(None) is None
+
+
+def test_plan_chunks():
+    from leicaautomator.utils import plan_chunks
+    chunks, halo_ratio = plan_chunks((1000, 1000), 'uint8', depth=4, workers=4)
+    assert chunks == ((500, 500), (500, 500))
+    assert abs(halo_ratio - (1008**2 / 1e6 - 1)) < 1e-9
+
+    # chunks not narrower than 8*depth, even with many workers
+    chunks, _ = plan_chunks((2000, 2000), 'uint8', depth=10, workers=1024)
+    assert min(min(c) for c in chunks) >= 80
+
+    # at most target_bytes per chunk
+    chunks, _ = plan_chunks((4096, 4096), 'uint16', workers=1,
+                            target_bytes=2**20)
+    assert max(chunks[0]) * max(chunks[1]) * 2 <= 2**20
+
+    # narrow axis can not be split, chunks are not multiplied along the other
+    chunks, halo_ratio = plan_chunks((3, 5000), 'uint8', depth=10, workers=4)
+    assert chunks == ((3,), (1250,) * 4)
+    assert abs(halo_ratio - (5060 / 5000 - 1)) < 1e-9
+
+
+def test_map_tiles():
+    import numpy as np
+    from leicaautomator.filters import mean
+    from leicaautomator.utils import map_tiles
+    img = np.random.RandomState(0).randint(0, 256, (64, 48)).astype(np.uint8)
+    selem = np.ones((5, 5))
+    out = np.empty_like(img)
+
+    hists = map_tiles(mean, img, out, chunks=((20, 20, 24), (16, 32)),
+                      depth=2, partial=lambda t: np.bincount(t.ravel()),
+                      extra_arguments=(selem,))
+
+    assert (out == mean(img, selem)).all()
+    assert sum(h.sum() for h in hists) == img.size
+
+
+def test_region_pipeline_dask(overview):
+    import dask.array as da
+    from leicaautomator.pipeline import RegionPipeline
+    regions = RegionPipeline(max_regions=12)(overview)
+    lazy = RegionPipeline(max_regions=12)(da.from_array(overview,
+                                                        chunks=(64, 64)))
+
+    assert [r.bbox for r in lazy] == [r.bbox for r in regions]
+    assert (lazy['well_x'] == regions['well_x']).all()
+
+
+def test_fused_pipeline(overview):
+    from leicaautomator.pipeline import RegionPipeline
+    regions = RegionPipeline(max_regions=12)(overview)
+    fused = RegionPipeline(max_regions=12, fused=True)(overview)
+
+    key = lambda r: (r.well_y, r.well_x)
+    assert [key(r) for r in sorted(fused, key=key)] == \
+           [key(r) for r in sorted(regions, key=key)]
+
+    # processes fall back to threads
+    processes = RegionPipeline(max_regions=12, fused=True,
+                               scheduler='processes')(overview)
+    assert [key(r) for r in sorted(processes, key=key)] == \
+           [key(r) for r in sorted(fused, key=key)]
+
+
+def test_streaming_thresholds(tmpdir):
+    import numpy as np
+    import dask.array as da
+    from skimage import filters
+    from leicaautomator.pipeline import otsu_threshold, li_threshold
+    rng = np.random.RandomState(0)
+    img = np.concatenate([rng.normal(60, 10, 5000),
+                          rng.normal(170, 20, 3000)]).clip(0, 255)
+    img = img.astype(np.uint8).reshape(80, 100)
+    mmap = np.lib.format.open_memmap(tmpdir.join('img.npy').strpath,
+                                     mode='w+', dtype=img.dtype,
+                                     shape=img.shape)
+    mmap[:] = img
+
+    for image in (img, mmap, da.from_array(img, chunks=(30, 40))):
+        otsu = np.asarray(otsu_threshold(image))
+        li = np.asarray(li_threshold(image))
+        inverted = np.asarray(li_threshold(image, invert=True))
+        assert (otsu == (img >= filters.threshold_otsu(img))).all()
+        assert (li == (img >= filters.threshold_li(img))).all()
+        assert (inverted == (img < filters.threshold_li(img))).all()
+
+    # same operator for images which are not streamed
+    floats = img.astype(np.float64)
+    t = filters.threshold_otsu(floats)
+    assert (otsu_threshold(floats) == (floats >= t)).all()
+
+
+def test_incremental_stitcher(experiment, tmpdir):
+    import os
+    import numpy as np
+    from leicaexperiment import attributes
+    from leicaautomator.pipeline import RegionPipeline
+    from leicaautomator.stream import IncrementalStitcher
+    from leicaautomator.utils import merge, register
+
+    # fields of a 2x3 scan written to a new experiment
+    scan = tmpdir.mkdir('scan')
+    images = []
+    for i in experiment.images:
+        attr = attributes(i)
+        if attr.y < 2 and attr.x < 3:
+            target = scan.join(os.path.relpath(i, experiment.path))
+            target.dirpath().ensure(dir=True)
+            path.local(i).copy(target)
+            images.append((target.strpath, attr.y, attr.x))
+
+    stitcher = IncrementalStitcher(scan.strpath, grid=(2, 3))
+    assert stitcher.poll() == [] # file sizes not yet known to be stable
+    assert len(stitcher.poll()) == 6
+
+    offset = register(images, scheduler='synchronous')
+    stitched = merge(images, offset)
+    assert stitcher.offset == tuple(int(round(o)) for o in offset)
+    assert (stitcher.image == stitched).all()
+
+    expected = RegionPipeline(fused=True)(stitched)
+    assert [r.bbox for r in stitcher.regions()] == [r.bbox for r in expected]
+
+    # well positions from the grid of the pipeline
+    stitcher.pipeline.grid = 'lattice'
+    expected = RegionPipeline(fused=True, grid='lattice')(stitched)
+    regions = stitcher.regions()
+    assert stitcher.pipeline.lattice is not None
+    assert (regions['well_x'] == expected['well_x']).all()
+    assert (regions['well_y'] == expected['well_y']).all()
+
+
+def test_stage_position(experiment):
+    import numpy as np
+    from leicaautomator.position import (construct_stage_position,
+                                         AffineTransform)
+
+    stage_position = construct_stage_position(experiment, (-53, -51))
+    y, x = np.array([0, 10, 250]), np.array([0, 20, 300])
+    Y, X = stage_position(y, x)
+    assert Y.shape == y.shape
+    assert stage_position(10, 20) == (Y[1], X[1])
+
+    # pixel -> stage -> pixel
+    transform = stage_position.transform
+    assert np.allclose(transform.inverse()(Y, X), (y, x))
+
+    rotate = AffineTransform.from_params(rotation=0.1, offset=(1, 2))
+    combined = rotate.compose(transform)
+    coords = np.stack([y, x], axis=-1)
+    assert np.allclose(combined.apply(coords),
+                       rotate.apply(transform.apply(coords)))
+
+
+def test_position_import():
+    import subprocess
+    import sys
+    # registration is only needed for stitching
+    code = ('import sys, leicaautomator.position; '
+            'assert "imreg_dft" not in sys.modules')
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+@pytest.mark.parametrize('bigtiff', [False, True])
+def test_image_info(experiment, tmpdir, bigtiff):
+    import numpy as np
+    from skimage.io import imread
+    from leicaautomator.utils import image_info, experiment_image_info
+    tifffile = pytest.importorskip('tifffile')
+
+    for dtype, shape in (('uint8', (37, 53)), ('uint16', (37, 53)),
+                         ('float32', (37, 53)), ('uint8', (37, 53, 3))):
+        filename = tmpdir.join('image.tif').strpath
+        tifffile.imwrite(filename, np.zeros(shape, dtype=dtype),
+                         bigtiff=bigtiff)
+        assert image_info(filename) == (shape, np.dtype(dtype))
+
+    img = imread(experiment.images[0])
+    assert experiment_image_info(experiment) == (img.shape, img.dtype)
+
+
+def test_save_regions(overview, tmpdir):
+    import os
+    import numpy as np
+    from leicaautomator.pipeline import RegionPipeline
+    from leicaautomator.utils import save_regions, load_regions
+
+    regions = RegionPipeline(max_regions=12)(overview)
+    filename = tmpdir.join('regions.npy').strpath
+    save_regions(filename, regions)
+    assert os.path.getsize(filename) < 2048
+
+    loaded = load_regions(filename)
+    assert isinstance(loaded.records, np.memmap)
+    assert loaded['label'].tolist() == [r.label for r in regions]
+    assert loaded['well_x'].tolist() == [r.well_x for r in regions]
+    assert np.allclose(loaded['centroid_y'], [r.centroid[0] for r in regions])
+    assert [tuple(b) for b in
+            loaded[['y', 'x', 'y_end', 'x_end']].tolist()] == \
+           [r.bbox for r in regions]
+
+
+def test_assign_wells_read_only(overview, tmpdir):
+    import numpy as np
+    from leicaautomator.lattice import fit_lattice
+    from leicaautomator.pipeline import (RegionPipeline, WellGrid,
+                                         set_well_positions)
+    from leicaautomator.utils import save_regions, load_regions
+
+    regions = RegionPipeline(max_regions=12)(overview)
+    filename = tmpdir.join('regions.npy').strpath
+    save_regions(filename, regions)
+    loaded = load_regions(filename) # memory mapped read only
+    loaded_wells = np.array(loaded[['well_x', 'well_y']])
+
+    assigned = set_well_positions(loaded)
+    assert [r.bbox for r in assigned] == [r.bbox for r in regions]
+    assert (assigned['well_x'] == regions['well_x']).all()
+    lattice = fit_lattice(loaded)
+    assert (lattice.assign(loaded).records == assigned.records).all()
+    grid = WellGrid(loaded)
+    assert (grid.regions['well_y'] == loaded['well_y']).all()
+    grid.move(grid.regions[0].label, 0, 5)
+    # input is not changed
+    assert (np.array(loaded[['well_x', 'well_y']]) == loaded_wells).all()
+
+
+def test_viewer_smoke(overview, monkeypatch):
+    "Plugins attach and settings give a pipeline, without showing the GUI."
+    pytest.importorskip('skimage.viewer')
+    monkeypatch.setenv('QT_QPA_PLATFORM', 'offscreen')
+    from leicaautomator.pipeline import RegionPipeline
+    from leicaautomator.viewer import (ImageViewer, PopBilateralPlugin,
+                                       MeanPlugin, OtsuPlugin, RegionPlugin,
+                                       MoveRegion)
+
+    viewer = ImageViewer(overview, preview=True, max_size=128)
+    viewer += PopBilateralPlugin()
+    viewer += MeanPlugin()
+    viewer += OtsuPlugin()
+    viewer += RegionPlugin()
+    region_plugin = viewer.plugins[-1]
+    assert viewer.preview_factor == 4
+    assert callable(region_plugin.move_region)
+    assert isinstance(region_plugin.move_tool, MoveRegion)
+    assert isinstance(viewer.region_pipeline(), RegionPipeline)
+
+
+def test_region_table(overview):
+    import numpy as np
+    from leicaautomator.pipeline import RegionPipeline
+    from leicaautomator.position import mean_well_displacement
+    from leicaautomator.regions import RegionTable
+    from leicaautomator.utils import zick_zack_sort
+
+    regions = RegionPipeline(max_regions=12)(overview)
+    assert isinstance(regions, RegionTable)
+
+    # rows are views into columns
+    r = regions[0]
+    r.x += 5
+    assert regions['x'][0] == r.x
+    assert r.bbox == tuple(regions[['y', 'x', 'y_end', 'x_end']][0].tolist())
+
+    added = regions.append(10, 20, 30, 40)
+    assert added.label == regions['label'].max()
+    assert added.area == 400 and added.centroid == (20, 30)
+    regions.remove(added.label)
+    assert len(regions) == 12
+
+    # columns first, every second column upwards
+    zz = zick_zack_sort(regions, ('well_x', 'well_y'))
+    assert zz['well_x'].tolist() == [0]*3 + [1]*3 + [2]*3 + [3]*3
+    assert zz['well_y'].tolist() == [0, 1, 2, 2, 1, 0]*2
+
+    dy, dx = mean_well_displacement(regions)
+    assert 80 < dy < 120 and 80 < dx < 120
+
+
+def test_well_grid(overview):
+    from leicaautomator.pipeline import RegionPipeline, WellGrid, assign_wells
+
+    regions = RegionPipeline(max_regions=12)(overview)
+    grid = WellGrid(regions)
+
+    def check():
+        assert (regions['well_x'] == assign_wells(regions['x'])).all()
+        assert (regions['well_y'] == assign_wells(regions['y'])).all()
+
+    # move a region of the first column to the right of the last column
+    r = regions[0]
+    label, well_y = r.label, r.well_y
+    grid.move(label, 0, regions['x'].max() - r.x + 100)
+    check()
+    assert regions[regions.index(label)].well_x == 4
+    assert regions[regions.index(label)].well_y == well_y
+
+    added = grid.add(-200, -200, -150, -150)
+    check()
+    assert (added.well_y, added.well_x) == (0, 0)
+    grid.remove(added.label)
+    check()
+    assert len(regions) == 12
+
+
+def test_fit_lattice(overview):
+    import numpy as np
+    from leicaautomator.lattice import fit_lattice
+    from leicaautomator.pipeline import RegionPipeline
+
+    # rotated 8x10 lattice without row 3 and some cores
+    rng = np.random.RandomState(0)
+    rotation, spacing = 0.05, (150, 120)
+    well_y, well_x = [w.ravel() for w in np.mgrid[:8, :10]]
+    keep = (well_y != 3) & (rng.rand(80) > 0.2)
+    well_y, well_x = well_y[keep], well_x[keep]
+    y = (40 + well_y*spacing[0]*np.cos(rotation) +
+         well_x*spacing[1]*np.sin(rotation) + rng.normal(0, 2, len(well_y)))
+    x = (30 - well_y*spacing[0]*np.sin(rotation) +
+         well_x*spacing[1]*np.cos(rotation) + rng.normal(0, 2, len(well_y)))
+
+    lattice = fit_lattice(y, x)
+    assert abs(lattice.rotation - rotation) < 0.01
+    assert np.allclose(lattice.spacing, spacing, rtol=0.01)
+    assert lattice.residual < 5
+    fitted_y, fitted_x = lattice.indices(y, x)
+    assert (fitted_y == well_y).all() and (fitted_x == well_x).all()
+
+    # same wells as gaps on the overview
+    pipeline = RegionPipeline(max_regions=12, grid='lattice')
+    regions = pipeline(overview)
+    expected = RegionPipeline(max_regions=12)(overview)
+    assert (regions.records == expected.records).all()
+    assert pipeline.lattice.residual < 5
+
+
+def test_region_index(overview):
+    import numpy as np
+    from leicaautomator.pipeline import RegionPipeline
+    from leicaautomator.position import AffineTransform
+    from leicaautomator.regions import RegionIndex
+
+    regions = RegionPipeline(max_regions=12)(overview)
+    index = RegionIndex(regions)
+
+    def brute(y, x):
+        return sorted(r.label for r in regions
+                      if r.y <= y <= r.y_end and r.x <= x <= r.x_end)
+
+    rng = np.random.RandomState(0)
+    for y, x in zip(rng.randint(0, 300, 200), rng.randint(0, 400, 200)):
+        assert index.at(y, x) == brute(y, x)
+    assert not index.overlaps()
+
+    # move first region onto second
+    a, b = regions[0], regions[1]
+    a.y, a.x, a.y_end, a.x_end = b.y + 2, b.x + 2, b.y_end + 2, b.x_end + 2
+    index.move(a.label, a.bbox)
+    assert index.overlaps() == {tuple(sorted((a.label, b.label)))}
+    assert index.at(b.y + 5, b.x + 5) == sorted([a.label, b.label])
+
+    index.remove(a.label)
+    assert index.at(b.y + 5, b.x + 5) == [b.label]
+    index.insert(100, (0, 0, 10, 10))
+    assert index.at(5, 5) == [100]
+
+    # stage position in meters, 1 um pixels
+    transform = AffineTransform.from_params(scale=(1e-6, 1e-6),
+                                            offset=(0.01, 0.02))
+    Y, X = transform(b.y + 5, b.x + 5)
+    assert index.at_stage(Y, X, transform) == [b.label]
+
+
+class FakeCAM(object):
+    "CAM server which replies to commands and finishes scans after a while."
+    def __init__(self, scan_time=0.3, images=2):
+        self.scan_time = scan_time
+        self.images = images
+        self.received = []
+
+    async def start(self):
+        import asyncio
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        import asyncio
+        from leicacam.cam import bytes_as_dict
+        writer.write(b'/app:matrix /sys:1 /inf:welcome\r\n')
+        while True:
+            data = await reader.read(1024)
+            if not data:
+                break
+            message = bytes_as_dict(data)
+            self.received.append(message)
+            writer.write(data + b'\r\n') # echo
+            if message.get('cmd') == 'startscan':
+                asyncio.ensure_future(self.scan(writer))
+        writer.close()
+
+    async def scan(self, writer):
+        import asyncio
+        await asyncio.sleep(self.scan_time)
+        for i in range(self.images):
+            writer.write(b'/relpath:image--L0000--F%02d.ome.tif\r\n' % i)
+        writer.write(b'/inf:scanfinished\r\n')
+
+
+def test_scan_orchestrator(experiment, overview, tmpdir):
+    import asyncio
+    from leicascanningtemplate import ScanningTemplate
+    from leicaautomator.pipeline import RegionPipeline
+    from leicaautomator.scan import ScanOrchestrator
+
+    template = tmpdir.join('{ScanningTemplate}base.xml').strpath
+    path.local(experiment.scanning_template).copy(path.local(template))
+    regions = RegionPipeline(max_regions=12)(overview)[:3]
+    stage_position = lambda y, x: (0.03 + y*1e-6, 0.05 + x*1e-6)
+
+    cam = FakeCAM()
+    async def main():
+        await cam.start()
+        orchestrator = ScanOrchestrator(template, regions, stage_position,
+                                        port=cam.port)
+        timings = await orchestrator.run()
+        await asyncio.sleep(0.05) # let server see the connection close
+        cam.server.close()
+        return orchestrator, timings
+    loop = asyncio.new_event_loop()
+    orchestrator, timings = loop.run_until_complete(main())
+    loop.close()
+
+    assert [t['labels'] for t in timings] == [[r.label] for r in regions]
+    assert all(t['images'] == 2 for t in timings)
+    loaded = [m['fil'] for m in cam.received if m.get('cmd') == 'load']
+    assert loaded == ['{ScanningTemplate}leicaautomator%d' % (i % 2)
+                      for i in range(3)]
+    for previous, current in zip(timings, timings[1:]):
+        # next template written while scanning, scans back to back
+        assert current['ready'] <= previous['finished']
+        assert current['idle'] < cam.scan_time
+
+    # last template at last region
+    tmpl = ScanningTemplate(orchestrator.filename(2))
+    field = tmpl.field(1, 1, 1, 1)
+    distance = float(tmpl.properties.ScanFieldStageDistanceX) * 1e-6
+    x = stage_position(regions[2].y, regions[2].x)[1] + distance / 2
+    assert abs(float(field.FieldXCoordinate) - x) < 1e-9
+
+
+def test_batch_template(experiment, overview, tmpdir):
+    import asyncio
+    import numpy as np
+    from leicascanningtemplate import ScanningTemplate
+    from leicaautomator.pipeline import RegionPipeline
+    from leicaautomator.position import construct_stage_position
+    from leicaautomator.scan import (ScanOrchestrator, batch_template,
+                                     write_batch_template)
+
+    base = experiment.scanning_template
+    regions = RegionPipeline(max_regions=12)(overview)
+    stage_position = construct_stage_position(experiment, (-53, -51))
+    filename = tmpdir.join('{ScanningTemplate}batch.xml').strpath
+    write_batch_template(base, filename, regions, stage_position)
+
+    tmpl = ScanningTemplate(filename)
+    distance = float(tmpl.properties.ScanFieldStageDistanceX) * 1e-6
+    assert distance == 1500e-6
+    assert tmpl.properties.EnableIndividualWellScanFieldCount.text == 'true'
+    assert len(tmpl.wells) == len(regions) == 12
+    assert int(tmpl.properties.attrib['TotalCountOfWells']) == 12
+    for r, well in zip(regions, tmpl.wells):
+        assert (int(well.attrib['WellX']), int(well.attrib['WellY'])) == \
+               (r.well_x + 1, r.well_y + 1)
+        fields = tmpl.well_fields(r.well_x + 1, r.well_y + 1)
+        counts = (int(well.attrib['YCountOfFields']),
+                  int(well.attrib['XCountOfFields']))
+        assert len(fields) == counts[0] * counts[1]
+        # fields cover bounding box
+        Y, X = stage_position(np.array([r.y, r.y_end]),
+                              np.array([r.x, r.x_end]))
+        first = tmpl.field(r.well_x + 1, r.well_y + 1, 1, 1)
+        assert np.isclose(float(first.FieldYCoordinate),
+                          Y.min() + distance/2, rtol=0, atol=1e-9)
+        assert np.isclose(float(first.FieldXCoordinate),
+                          X.min() + distance/2, rtol=0, atol=1e-9)
+        assert counts[0] * distance >= np.ptp(Y) - 1e-9
+        assert counts[1] * distance >= np.ptp(X) - 1e-9
+        assert (counts[0] - 1) * distance < np.ptp(Y)
+
+    regions[1].well_x, regions[1].well_y = regions[0].well_x, regions[0].well_y
+    with pytest.raises(ValueError):
+        batch_template(base, regions, stage_position)
+    regions[1].well_x = -1
+    with pytest.raises(ValueError):
+        batch_template(base, regions, stage_position)
+
+    # one load and one scan
+    template = tmpdir.join('{ScanningTemplate}base.xml').strpath
+    path.local(base).copy(path.local(template))
+    regions = RegionPipeline(max_regions=12)(overview)
+    cam = FakeCAM()
+    async def main():
+        await cam.start()
+        orchestrator = ScanOrchestrator(template, regions, stage_position,
+                                        port=cam.port, batch=True)
+        timings = await orchestrator.run()
+        await asyncio.sleep(0.05)
+        cam.server.close()
+        return timings
+    loop = asyncio.new_event_loop()
+    timings = loop.run_until_complete(main())
+    loop.close()
+    assert len(timings) == 1
+    assert timings[0]['labels'] == [r.label for r in regions]
+    assert [m.get('cmd') for m in cam.received] == ['load', 'startscan']
+
+
+def test_plan_route():
+    import itertools
+    import numpy as np
+    from leicaautomator.pipeline import set_well_positions
+    from leicaautomator.regions import RegionTable
+    from leicaautomator.route import StageSpeed, plan_route, travel_times
+
+    speed = StageSpeed(speed=0.01, acceleration=0.05, settle=0.1)
+    # short move never reaches full speed, long move does
+    assert np.isclose(speed(0.0005, 0), 2*np.sqrt(0.0005/0.05) + 0.1)
+    assert np.isclose(speed(0, -0.01), 0.01/0.01 + 0.01/0.05 + 0.1)
+    assert speed(0, 0) == 0
+
+    stage_position = lambda y, x: (np.asarray(y)*1e-6, np.asarray(x)*1e-6)
+    rng = np.random.RandomState(0)
+    # optimal on small sets
+    for n in range(1, 7):
+        regions = RegionTable()
+        for y, x in rng.randint(0, 20000, (n, 2)):
+            regions.append(y, x, y+500, x+500)
+        regions = set_well_positions(regions)
+        route = plan_route(regions, stage_position, start=(0, 0))
+        assert sorted(route.order) == list(range(n))
+        Y, X = stage_position(regions['y'] + 250, regions['x'] + 250)
+        times = travel_times(np.append(Y, 0), np.append(X, 0))
+        best = min(times[n, p[0]] + times[p[:-1], p[1:]].sum()
+                   for p in map(list, itertools.permutations(range(n))))
+        assert route.time <= best + 1e-9
+
+    # two slides with missing cores, not worse than zick zack
+    regions = RegionTable()
+    for offset in (0, 30000):
+        for row in range(8):
+            for column in range(6):
+                if rng.rand() < 0.7:
+                    y, x = row * 1500, offset + column * 1500
+                    regions.append(y, x, y+1000, x+1000)
+    regions = set_well_positions(regions)
+    route = plan_route(regions, stage_position)
+    assert route.time < route.zick_zack_time
+    assert route.saved > 0
+    assert len(route(regions)) == len(regions)
+
+
+def test_plan_fields(experiment, tmpdir):
+    import numpy as np
+    from leicascanningtemplate import ScanningTemplate
+    from leicaautomator.pipeline import extract_regions, set_well_positions
+    from leicaautomator.scan import batch_template
+    from leicaautomator.tiling import plan_fields, region_mask
+
+    # round core, 10 um pixels -> fields are 150 pixels
+    yy, xx = np.mgrid[:1000, :1400]
+    binary = (yy - 500)**2 + (xx - 500)**2 < 400**2
+    # other core reaching into bounding box
+    binary |= (yy - 50)**2 + (xx - 1250)**2 < 390**2
+    stage_position = lambda y, x: (0.03 + np.asarray(y) * 10e-6,
+                                   0.05 + np.asarray(x) * 10e-6)
+    regions = set_well_positions(extract_regions(binary, 2))
+    index = int(np.argmin(regions['x']))
+    region = regions[index]
+    distance = (1500e-6, 1500e-6)
+
+    mask = region_mask(region, binary)
+    assert mask.sum() == region.area
+    start, fields = plan_fields(region, binary, stage_position, distance)
+    assert len(set(fields)) == len(fields)
+    bbox_fields = (int(np.ceil((region.y_end - region.y) / 150)) *
+                   int(np.ceil((region.x_end - region.x) / 150)))
+    assert len(fields) < 0.9 * bbox_fields
+    # every tissue pixel is in a field
+    ys, xs = np.nonzero(mask)
+    Y, X = stage_position(ys + region.y, xs + region.x)
+    # pixels on field edges belong to the next field
+    field_y = np.floor((Y - start[0]) / distance[0] + 0.5 + 1e-9).astype(int)
+    field_x = np.floor((X - start[1]) / distance[1] + 0.5 + 1e-9).astype(int)
+    assert set(zip(field_y.tolist(), field_x.tolist())) <= set(fields)
+
+    tmpl = batch_template(experiment.scanning_template, regions[[index]],
+                          stage_position, binary=binary)
+    # full grid of fields, fields without tissue are disabled
+    well = tmpl.wells[0]
+    assert len(tmpl.fields) == (int(well.attrib['XCountOfFields']) *
+                                int(well.attrib['YCountOfFields']))
+    enabled = set((int(f.attrib['FieldY']) - 1, int(f.attrib['FieldX']) - 1)
+                  for f in tmpl.fields if f.attrib['Enabled'] == 'true')
+    assert enabled == set(fields)
+    assert len(tmpl.fields) > len(fields)
+
+
+def test_plan_fields_sizes():
+    import numpy as np
+    from leicaautomator.regions import RegionTable
+    from leicaautomator.tiling import plan_fields
+
+    yy, xx = np.mgrid[:40, :50]
+    binary = (yy - 20)**2 + (xx - 25)**2 < 15**2
+    regions = RegionTable()
+    regions.append(5, 10, 35, 40)
+    stage_position = lambda y, x: (np.asarray(y) * 1e-6,
+                                   np.asarray(x) * 1e-6)
+    # non integer field sizes in pixels, from smaller than a pixel to
+    # larger than the region
+    for size in np.linspace(0.5, 40, 350):
+        distance = (size * 1e-6, size * 1.3e-6)
+        start, fields = plan_fields(regions[0], binary, stage_position,
+                                    distance)
+        assert len(fields) == len(set(fields)) > 0